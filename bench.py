@@ -0,0 +1,577 @@
+# Нагрузочный прогон бота без сети: Google Sheets и Telegram подменяются
+# фейками внутри процесса, апдейты идут через настоящий /webhook.
+#
+#   python bench.py                                   # смесь сценариев по умолчанию
+#   python bench.py --sessions 200 --concurrency 16 --sheets-latency-ms 120
+#   python bench.py --mix quick=1 --sheets-error-rate 0.05 --json
+#   python bench.py --transports                      # discovery против SHEETS_TRANSPORT=rest
+#
+# Переменные окружения main.py работают как обычно (WEBHOOK_ASYNC=1, OPS_INDEX=0 ...),
+# но лимиты отправки Telegram и квоты Sheets по умолчанию сняты — иначе замеряется только паузер
+# (SHEETS_WRITE_RPM=60 python bench.py — прогон с настоящими квотами).
+import argparse
+import gzip
+import http.server
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import Counter, defaultdict
+
+import requests
+import requests.adapters
+
+_tmp = tempfile.mkdtemp(prefix="bench-")
+for k, v in {
+    "TELEGRAM_TOKEN": "bench",
+    "TELEGRAM_SECRET_TOKEN": "bench",
+    "SPREADSHEET_ID": "bench",
+    "JOURNAL_DB": os.path.join(_tmp, "journal.sqlite3"),
+    "STATE_DB": os.path.join(_tmp, "state.sqlite3"),
+    "LOG_FALLBACK_FILE": os.path.join(_tmp, "logs_fallback.jsonl"),
+    "TG_CHAT_RATE": "1000",
+    "TG_CHAT_BURST": "1000",
+    "TG_GLOBAL_RATE": "100000",
+    "SHEETS_READ_RPM": "0",
+    "SHEETS_WRITE_RPM": "0",
+}.items():
+    os.environ.setdefault(k, v)
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+import main
+
+
+# =========================
+# FAKE SHEETS
+# =========================
+def _col_idx(col: str) -> int:
+    n = 0
+    for ch in col:
+        n = n * 26 + ord(ch) - 64
+    return n - 1
+
+def _col_name(idx: int) -> str:
+    s = ""
+    idx += 1
+    while idx:
+        idx, r = divmod(idx - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+
+class _Request:
+    def __init__(self, sheets, kind: str, fn):
+        self.sheets = sheets
+        self.kind = kind
+        self.fn = fn
+
+    def execute(self, **kwargs):
+        return self.sheets._execute(self.kind, self.fn)
+
+
+class FakeSheets:
+    # повторяет цепочку googleapiclient: spreadsheets().values().append(...).execute()
+    def __init__(self, latency_ms: float = 0, error_rate: float = 0, seed: int = 0, error_status: int = 503):
+        self.latency = latency_ms / 1000.0
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rnd = random.Random(seed)
+        self.data = {}         # title -> [[cell, ...], ...]
+        self.ids = {}          # title -> sheetId
+        self.calls = Counter()
+        self.errors = Counter()
+        self.rows_written = 0
+        self.rows_read = 0
+        self.lock = threading.Lock()
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def _sheet(self, title: str) -> list:
+        title = title.strip("'")
+        if title not in self.data:
+            self.data[title] = []
+            self.ids[title] = 1000 + len(self.ids)
+        return self.data[title]
+
+    def _execute(self, kind: str, fn):
+        with self.lock:
+            self.calls[kind] += 1
+            fail = self.rnd.random() < self.error_rate
+            delay = self.latency * self.rnd.uniform(0.5, 1.5)
+        if delay:
+            time.sleep(delay)
+        if fail:
+            with self.lock:
+                self.errors[kind] += 1
+            body = json.dumps({"error": {"code": self.error_status, "message": "bench"}}).encode()
+            raise HttpError(httplib2.Response({"status": self.error_status}), body)
+        with self.lock:
+            return fn()
+
+    def _read(self, rng: str, major: str = "ROWS") -> dict:
+        title, _, a1 = rng.rpartition("!")
+        if not title:
+            title, a1 = a1, "A:ZZ"
+        rows = self._sheet(title)
+        first, _, last = a1.partition(":")
+        last = last or first
+        c1 = first.rstrip("0123456789")
+        c2 = last.rstrip("0123456789")
+        r1 = int(first[len(c1):] or 1)
+        r2 = int(last[len(c2):] or len(rows))
+        i1, i2 = _col_idx(c1), _col_idx(c2)
+        out = []
+        for row in rows[r1 - 1:r2]:
+            seg = [str(x) for x in row[i1:i2 + 1]]
+            while seg and seg[-1] == "":
+                seg.pop()
+            out.append(seg)
+        while out and not out[-1]:
+            out.pop()
+        self.rows_read += len(out)
+        if major == "COLUMNS":
+            width = max((len(r) for r in out), default=0)
+            out = [[(r[i] if i < len(r) else "") for r in out] for i in range(width)]
+            for col in out:
+                while col and col[-1] == "":
+                    col.pop()
+        return {"range": rng, "values": out} if out else {"range": rng}
+
+    def append(self, spreadsheetId=None, range=None, body=None, **kwargs):
+        def fn():
+            title = range.rpartition("!")[0] or range
+            rows = self._sheet(title)
+            start = len(rows) + 1
+            rows.extend(list(v) for v in body["values"])
+            width = max(len(v) for v in body["values"])
+            self.rows_written += len(body["values"])
+            return {"updates": {
+                "updatedRange": f"'{title.strip(chr(39))}'!A{start}:{_col_name(width - 1)}{len(rows)}",
+                "updatedRows": len(body["values"]),
+            }}
+        return _Request(self, "values.append", fn)
+
+    def get(self, spreadsheetId=None, range=None, majorDimension="ROWS", **kwargs):
+        if range is None:
+            def meta():
+                return {"sheets": [
+                    {"properties": {"title": t, "sheetId": i, "gridProperties": {"rowCount": len(self.data[t]) + 1000}}}
+                    for t, i in self.ids.items()
+                ]}
+            return _Request(self, "get", meta)
+        return _Request(self, "values.get", lambda: self._read(range, majorDimension))
+
+    def batchGet(self, spreadsheetId=None, ranges=None, majorDimension="ROWS", **kwargs):
+        return _Request(self, "values.batchGet",
+                        lambda: {"valueRanges": [self._read(r, majorDimension) for r in ranges]})
+
+    def batchUpdate(self, spreadsheetId=None, body=None, **kwargs):
+        def fn():
+            for rq in body["requests"]:
+                if "deleteDimension" in rq:
+                    r = rq["deleteDimension"]["range"]
+                    title = next(t for t, i in self.ids.items() if i == r["sheetId"])
+                    del self.data[title][r["startIndex"]:r["endIndex"]]
+                elif "addSheet" in rq:
+                    props = rq["addSheet"]["properties"]
+                    self._sheet(props["title"])
+                    if "sheetId" in props:
+                        self.ids[props["title"]] = props["sheetId"]
+                elif "appendCells" in rq:
+                    r = rq["appendCells"]
+                    title = next(t for t, i in self.ids.items() if i == r["sheetId"])
+                    self.data[title].extend(
+                        [c.get("userEnteredValue", {}).get("stringValue", "") for c in row.get("values", [])]
+                        for row in r["rows"]
+                    )
+            return {"replies": [{} for _ in body["requests"]]}
+        return _Request(self, "batchUpdate", fn)
+
+
+# =========================
+# FAKE TELEGRAM
+# =========================
+class FakeTelegramAdapter(requests.adapters.BaseAdapter):
+    # монтируется в session TelegramClient — ретраи, 429 и пул соединений остаются настоящими
+    def __init__(self, latency_ms: float = 0, error_rate: float = 0, seed: int = 0):
+        super().__init__()
+        self.latency = latency_ms / 1000.0
+        self.error_rate = error_rate
+        self.rnd = random.Random(seed)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        method = request.url.rsplit("/", 1)[-1]
+        with self.lock:
+            self.calls[method] += 1
+            self.bytes_sent += len(request.body or b"")
+            fail = self.rnd.random() < self.error_rate
+            delay = self.latency * self.rnd.uniform(0.5, 1.5)
+        if delay:
+            time.sleep(delay)
+        resp = requests.Response()
+        resp.request = request
+        resp.url = request.url
+        resp.headers["Content-Type"] = "application/json"
+        if fail:
+            with self.lock:
+                self.errors[method] += 1
+            resp.status_code = 502
+            resp._content = b'{"ok":false,"error_code":502}'
+        else:
+            resp.status_code = 200
+            resp._content = b'{"ok":true,"result":{"message_id":1}}'
+        return resp
+
+    def close(self):
+        pass
+
+
+# =========================
+# СЦЕНАРИИ
+# =========================
+EMPLOYEES = ["ИВАНОВ", "ПЕТРОВ", "СИДОРОВ", "Тогаев Шохрух", "Ахмедов Отабек", "Маматисойв Акмалжон"]
+
+def _quick_line(rnd, i):
+    return "; ".join([
+        rnd.choice(main.OBJECTS), "РАСХОД", rnd.choice(main.ARTICLES), str(rnd.randint(100, 90000)),
+        rnd.choice(main.PAY_TYPES), rnd.choice(main.VAT_VALUES), "2026-01-1", rnd.choice(EMPLOYEES), f"bench {i}",
+    ])
+
+def scenario_new(rnd):
+    return [
+        "/new", rnd.choice(main.OBJECTS), rnd.choice(main.TYPES), rnd.choice(main.ARTICLES),
+        str(rnd.randint(100, 90000)), rnd.choice(main.PAY_TYPES), rnd.choice(main.VAT_VALUES),
+        "2026-01-2", rnd.choice(EMPLOYEES), "-",
+    ]
+
+def scenario_bulk(rnd):
+    hdr = f"{rnd.choice(main.OBJECTS)}; ЗП НАЛ; НАЛ; НЕТ; 2026-01-1; авансы"
+    lines = [f"{rnd.choice(EMPLOYEES)} {n} - {rnd.randint(1, 30)}к" for n in range(rnd.randint(5, 40))]
+    return ["/bulk", hdr, "\n".join(lines), "/done"]
+
+def scenario_quick(rnd):
+    burst = [_quick_line(rnd, i) for i in range(rnd.randint(2, 6))]
+    burst.append("\n".join(_quick_line(rnd, 100 + i) for i in range(rnd.randint(2, 10))))
+    return burst
+
+def scenario_undo(rnd):
+    return [_quick_line(rnd, 0), _quick_line(rnd, 1), "/undo", "/undo"]
+
+SCENARIOS = {"new": scenario_new, "bulk": scenario_bulk, "quick": scenario_quick, "undo": scenario_undo}
+
+
+# =========================
+# ПРОГОН
+# =========================
+def _percentile(sorted_vals: list, p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, max(0, int(round(p / 100.0 * len(sorted_vals) + 0.5)) - 1))
+    return sorted_vals[idx]
+
+def _parse_mix(s: str) -> dict:
+    mix = {}
+    for part in s.split(","):
+        name, _, w = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise SystemExit(f"неизвестный сценарий: {name} (есть: {', '.join(SCENARIOS)})")
+        mix[name] = float(w or 1)
+    return mix
+
+def run(args) -> dict:
+    sheets = FakeSheets(args.sheets_latency_ms, args.sheets_error_rate, args.seed, args.sheets_error_status)
+    tg = FakeTelegramAdapter(args.tg_latency_ms, args.tg_error_rate, args.seed + 1)
+    main._sheets_service = sheets
+    main.SPREADSHEET_ID = "bench"
+    main.telegram_client().session.mount("https://api.telegram.org/", tg)
+
+    for i in range(args.preload):
+        sheets._sheet(main.SHEET_OPS).append(
+            ["", main.OBJECTS[i % len(main.OBJECTS)], "РАСХОД", "КВАРТИРА", "1000", "НАЛ", "НЕТ", "2026-01-1",
+             "ИВАНОВ", "", "", "", f"pre{i}", "preload"]
+        )
+
+    rnd = random.Random(args.seed)
+    mix = _parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+    sessions = [(10_000_000 + n, name, SCENARIOS[name](rnd))
+                for n, name in enumerate(rnd.choices(names, weights, k=args.sessions))]
+
+    latencies = defaultdict(list)   # сценарий -> [секунды на апдейт]
+    statuses = Counter()
+    ids = iter(range(1, 10 ** 9))
+    ids_lock = threading.Lock()
+    work = list(reversed(sessions))
+    work_lock = threading.Lock()
+    headers = {"X-Telegram-Bot-Api-Secret-Token": main.TELEGRAM_SECRET_TOKEN}
+
+    def worker():
+        client = main.app.test_client()
+        while True:
+            with work_lock:
+                if not work:
+                    return
+                chat_id, name, texts = work.pop()
+            # один чат — один поток: порядок сообщений внутри сессии как у живого пользователя
+            for text in texts:
+                with ids_lock:
+                    uid = next(ids)
+                update = {"update_id": uid, "message": {
+                    "message_id": uid, "chat": {"id": chat_id},
+                    "from": {"id": chat_id, "first_name": "Bench"}, "text": text,
+                }}
+                t0 = time.perf_counter()
+                resp = client.post("/webhook", json=update, headers=headers)
+                dt = time.perf_counter() - t0
+                with work_lock:
+                    latencies[name].append(dt)
+                    statuses[resp.status_code] += 1
+
+    t_start = time.perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    t_acked = time.perf_counter()
+    # в ack-first режиме апдейты ещё в очередях — дожидаемся, чтобы посчитать все вызовы
+    main._shutdown()
+    t_done = time.perf_counter()
+
+    updates = sum(len(v) for v in latencies.values())
+    every = sorted(dt for v in latencies.values() for dt in v)
+
+    def summary(vals):
+        vals = sorted(vals)
+        return {
+            "updates": len(vals),
+            "p50_ms": round(_percentile(vals, 50) * 1000, 2),
+            "p95_ms": round(_percentile(vals, 95) * 1000, 2),
+            "p99_ms": round(_percentile(vals, 99) * 1000, 2),
+            "max_ms": round((vals[-1] if vals else 0) * 1000, 2),
+        }
+
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "json"},
+        "async": main.WEBHOOK_ASYNC,
+        "sessions": len(sessions),
+        "updates": updates,
+        "http_status": dict(statuses),
+        "wall_s": round(t_done - t_start, 3),
+        "drain_s": round(t_done - t_acked, 3),
+        "throughput_ups": round(updates / max(t_done - t_start, 1e-9), 1),
+        "latency": summary(every),
+        "by_scenario": {name: summary(v) for name, v in sorted(latencies.items())},
+        "sheets_calls": dict(sheets.calls),
+        "sheets_errors": dict(sheets.errors),
+        "sheets_calls_per_update": round(sum(sheets.calls.values()) / max(updates, 1), 3),
+        "sheets_rows_written": sheets.rows_written,
+        "sheets_rows_read": sheets.rows_read,
+        "telegram_calls": dict(tg.calls),
+        "telegram_errors": dict(tg.errors),
+        "telegram_calls_per_update": round(sum(tg.calls.values()) / max(updates, 1), 3),
+        "telegram_bytes_sent": tg.bytes_sent,
+    }
+
+def _print_report(rep: dict):
+    print(f"sessions={rep['sessions']} updates={rep['updates']} async={rep['async']} "
+          f"http={rep['http_status']}")
+    print(f"wall {rep['wall_s']}s (drain {rep['drain_s']}s), throughput {rep['throughput_ups']} updates/s")
+    print(f"{'':10} {'updates':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    rows = [("ALL", rep["latency"])] + list(rep["by_scenario"].items())
+    for name, s in rows:
+        print(f"{name:10} {s['updates']:>8} {s['p50_ms']:>9} {s['p95_ms']:>9} {s['p99_ms']:>9} {s['max_ms']:>9}")
+    print(f"sheets:   {rep['sheets_calls_per_update']} calls/update {rep['sheets_calls']} "
+          f"errors={rep['sheets_errors']} rows w/r={rep['sheets_rows_written']}/{rep['sheets_rows_read']}")
+    print(f"telegram: {rep['telegram_calls_per_update']} calls/update {rep['telegram_calls']} "
+          f"errors={rep['telegram_errors']} bytes={rep['telegram_bytes_sent']}")
+
+# =========================
+# ТРАНСПОРТЫ SHEETS (--transports)
+# =========================
+# Локальный HTTP-сервер с REST v4 поверх FakeSheets: один и тот же набор запросов
+# гоняется через googleapiclient (discovery) и через main.SheetsRest.
+class _SheetsHTTPHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive, как у настоящего API
+    disable_nagle_algorithm = True  # иначе заголовки и тело ответа ловят delayed ACK (~40 мс)
+    sheets = None
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status: int, obj):
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        if "gzip" in (self.headers.get("Accept-Encoding") or ""):
+            data = gzip.compress(data, 1)
+            self.send_response(status)
+            self.send_header("Content-Encoding", "gzip")
+        else:
+            self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self, method: str):
+        url = urllib.parse.urlsplit(self.path)
+        q = urllib.parse.parse_qs(url.query)
+        path = urllib.parse.unquote(url.path)
+        if not path.startswith("/v4/spreadsheets/"):
+            return self._reply(404, {"error": {"code": 404}})
+        rest = path[len("/v4/spreadsheets/"):]
+        sid, _, tail = rest.partition("/")
+        body = None
+        if method == "POST":
+            n = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(n) or b"{}")
+        major = (q.get("majorDimension") or ["ROWS"])[0]
+        sh = self.sheets
+        if method == "POST" and tail.startswith("values/") and tail.endswith(":append"):
+            req = sh.append(range=tail[len("values/"):-len(":append")], body=body)
+        elif method == "GET" and tail == "values:batchGet":
+            req = sh.batchGet(ranges=q.get("ranges", []), majorDimension=major)
+        elif method == "GET" and tail.startswith("values/"):
+            req = sh.get(range=tail[len("values/"):], majorDimension=major)
+        elif method == "POST" and sid.endswith(":batchUpdate"):
+            req = sh.batchUpdate(body=body)
+        elif method == "GET" and not tail:
+            req = sh.get()
+        else:
+            return self._reply(404, {"error": {"code": 404, "message": path}})
+        try:
+            self._reply(200, req.execute())
+        except HttpError as e:
+            self._reply(e.resp.status, {"error": {"code": e.resp.status, "message": "bench"}})
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+
+def _transport_ops(svc, sid_ops: int):
+    # (имя, фабрика запроса) — ровно те вызовы, что делает бот
+    row = ["2026-01-01 10:00:00", "ОБУХОВО", "РАСХОД", "КВАРТИРА", 1000, "НАЛ", "НЕТ", "2026-01-1",
+           "ИВАНОВ", "", "", "", "999", "bench"]
+    ops = main.SHEET_OPS
+    return [
+        ("values.append", lambda: svc.spreadsheets().values().append(
+            spreadsheetId="bench", range=ops, valueInputOption="USER_ENTERED",
+            insertDataOption="INSERT_ROWS", body={"majorDimension": "ROWS", "values": [row]})),
+        ("values.get", lambda: svc.spreadsheets().values().get(
+            spreadsheetId="bench", range=f"{ops}!A1:N200", majorDimension="ROWS")),
+        ("values.batchGet", lambda: svc.spreadsheets().values().batchGet(
+            spreadsheetId="bench", ranges=[f"{ops}!M1:N1", f"{ops}!A10:N12", f"{ops}!A100:N100"],
+            majorDimension="ROWS")),
+        ("batchUpdate", lambda: svc.spreadsheets().batchUpdate(
+            spreadsheetId="bench", body={"requests": [{"deleteDimension": {"range": {
+                "sheetId": sid_ops, "dimension": "ROWS", "startIndex": 2000, "endIndex": 2001}}}]})),
+        ("spreadsheets.get", lambda: svc.spreadsheets().get(
+            spreadsheetId="bench", fields="sheets(properties(sheetId,title))")),
+    ]
+
+def run_transports(args) -> dict:
+    from google.auth.credentials import AnonymousCredentials
+    from googleapiclient.discovery import build
+
+    sheets = FakeSheets(args.sheets_latency_ms, 0, args.seed)
+    for i in range(args.preload):
+        sheets._sheet(main.SHEET_OPS).append(["", "ОБУХОВО", "РАСХОД", "КВАРТИРА", "1000", "НАЛ", "НЕТ",
+                                              "2026-01-1", "ИВАНОВ", "", "", "", f"pre{i}", "preload"])
+    handler = type("Handler", (_SheetsHTTPHandler,), {"sheets": sheets})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    clients = {
+        "discovery": build("sheets", "v4", credentials=AnonymousCredentials(), cache_discovery=False,
+                           static_discovery=True, client_options={"api_endpoint": base + "/"}),
+        "rest": main.SheetsRest(main._sheets_rest_session(AnonymousCredentials()), base),
+    }
+    sid_ops = sheets.ids[main.SHEET_OPS]
+    out = {}
+    try:
+        for name, svc in clients.items():
+            timings = defaultdict(list)
+            ops = _transport_ops(svc, sid_ops)
+            for _, make in ops:      # прогрев: соединение, discovery-объекты
+                make().execute()
+            for _ in range(args.iterations):
+                for op, make in ops:
+                    t0 = time.perf_counter()
+                    make().execute()
+                    timings[op].append(time.perf_counter() - t0)
+            out[name] = {op: {
+                "p50_ms": round(_percentile(sorted(v), 50) * 1000, 3),
+                "p95_ms": round(_percentile(sorted(v), 95) * 1000, 3),
+                "p99_ms": round(_percentile(sorted(v), 99) * 1000, 3),
+            } for op, v in timings.items()}
+    finally:
+        server.shutdown()
+    return {"iterations": args.iterations, "preload": args.preload, "transports": out}
+
+def _print_transports(rep: dict):
+    print(f"iterations={rep['iterations']} preload={rep['preload']} rows")
+    names = list(rep["transports"])
+    print(f"{'':18}" + "".join(f"{n + ' p50':>16}{n + ' p95':>16}" for n in names) + f"{'p50 ratio':>11}")
+    for op in rep["transports"][names[0]]:
+        cells = "".join(f"{rep['transports'][n][op]['p50_ms']:>16}{rep['transports'][n][op]['p95_ms']:>16}"
+                        for n in names)
+        a = rep["transports"][names[0]][op]["p50_ms"]
+        b = rep["transports"][names[-1]][op]["p50_ms"]
+        print(f"{op:18}{cells}{(a / b if b else 0):>11.2f}")
+
+def main_cli(argv=None):
+    p = argparse.ArgumentParser(description="Офлайн-нагрузка на /webhook с фейковыми Sheets и Telegram")
+    p.add_argument("--sessions", type=int, default=100, help="сколько пользовательских сессий (сценариев) прогнать")
+    p.add_argument("--concurrency", type=int, default=8, help="параллельных чатов")
+    p.add_argument("--mix", default="new=3,bulk=1,quick=4,undo=1", help="веса сценариев: new,bulk,quick,undo")
+    p.add_argument("--preload", type=int, default=2000, help="строк в ОПЕРАЦИИ до старта")
+    p.add_argument("--sheets-latency-ms", type=float, default=0)
+    p.add_argument("--sheets-error-rate", type=float, default=0)
+    p.add_argument("--sheets-error-status", type=int, default=503, help="HTTP-статус ошибки Sheets (429 — квота)")
+    p.add_argument("--tg-latency-ms", type=float, default=0)
+    p.add_argument("--tg-error-rate", type=float, default=0)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--transports", action="store_true",
+                   help="сравнить транспорты Sheets (discovery и rest) на локальном HTTP-сервере")
+    p.add_argument("--iterations", type=int, default=200, help="повторов каждого запроса в --transports")
+    p.add_argument("--json", action="store_true", help="отчёт одной JSON-строкой (для сравнения прогонов в CI)")
+    args = p.parse_args(argv)
+
+    # print из бота (ошибки Sheets и т.п.) не должен смешиваться с отчётом
+    real_stdout = sys.stdout
+    sys.stdout = open(os.path.join(_tmp, "bot.out"), "w", encoding="utf-8")
+    try:
+        rep = run_transports(args) if args.transports else run(args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = real_stdout
+
+    if args.json:
+        print(json.dumps(rep, ensure_ascii=False))
+    elif args.transports:
+        _print_transports(rep)
+    else:
+        _print_report(rep)
+        print(f"вывод бота: {os.path.join(_tmp, 'bot.out')}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,25 @@
+# Конфиг gunicorn (Procfile: gunicorn -c gunicorn.conf.py ... main:app).
+# Прогрев идёт в каждом воркере уже после fork: клиенты Sheets/Telegram держат сокеты,
+# их нельзя создавать в мастере и делить между процессами.
+#
+# Воркер по умолчанию один (--workers 1 в Procfile, WEB_CONCURRENCY его не меняет). Несколько
+# воркеров — только со STATE_BACKEND=sqlite, и даже тогда у каждого процесса своё: зеркало
+# ОПЕРАЦИИ (/report и /find не видят строк соседа до перечитывания), лимиты отправки в Telegram,
+# блокировка /export и раскладка апдейтов по чатам.
+import os
+
+
+def on_starting(server):
+    # мастер: main здесь не импортируем, хватает переменных окружения
+    backend = os.environ.get("STATE_BACKEND", "memory").strip().lower()
+    if server.cfg.workers > 1 and backend != "sqlite":
+        raise RuntimeError(
+            f"workers={server.cfg.workers} требует STATE_BACKEND=sqlite: "
+            "с памятью шаги /new и /bulk теряются между процессами"
+        )
+
+
+def post_fork(server, worker):
+    import main
+    if main.PREWARM:
+        main.warm_up()
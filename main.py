@@ -1,12 +1,30 @@
+import time
+_boot_t0 = time.perf_counter()   # cold start: сколько занял импорт модуля
+
 from flask import Flask, request
+from collections import OrderedDict, namedtuple
+import itertools
+import heapq
+import random
+from types import MappingProxyType, SimpleNamespace
+from urllib.parse import quote
 import os
+import sys
+import csv
+import gzip
 import json
-import time
+import secrets
+import tempfile
 import re
+import queue
+import atexit
+import sqlite3
+import threading
 import requests
+from concurrent.futures import Future
+import requests.adapters
 from datetime import datetime
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+# google.oauth2 и googleapiclient (~0.2 с импорта) подгружаются в build_sheets_service
 
 app = Flask(__name__)
 
@@ -15,6 +33,7 @@ app = Flask(__name__)
 # =========================
 TOKEN = os.environ.get("TELEGRAM_TOKEN", "").strip()
 TG_API = f"https://api.telegram.org/bot{TOKEN}"
+TG_FILE_API = f"https://api.telegram.org/file/bot{TOKEN}"
 
 SPREADSHEET_ID = os.environ.get("SPREADSHEET_ID", "").strip()
 SHEET_OPS = os.environ.get("SHEET_OPS", "ОПЕРАЦИИ").strip()
@@ -30,9 +49,26 @@ TELEGRAM_SECRET_TOKEN = os.environ.get("TELEGRAM_SECRET_TOKEN", "").strip()
 # ALLOWED_CHAT_IDS="123,-100555,..." (через запятую)
 ALLOWED_CHAT_IDS = os.environ.get("ALLOWED_CHAT_IDS", "").strip()
 
+def _env_flag(name: str, default: str = "") -> bool:
+    return os.environ.get(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+# Ack-first режим: /webhook только проверяет секрет, кладёт апдейт в очередь и сразу
+# отвечает 200, а Sheets/Telegram обрабатывают фоновые воркеры.
+WEBHOOK_ASYNC = _env_flag("WEBHOOK_ASYNC")
+WEBHOOK_WORKERS = max(1, int(os.environ.get("WEBHOOK_WORKERS", "4")))
+WEBHOOK_QUEUE_SIZE = max(1, int(os.environ.get("WEBHOOK_QUEUE_SIZE", "200")))  # на каждого воркера
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.environ.get("WEBHOOK_ENQUEUE_TIMEOUT", "0.5"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", "25"))
+
 # =========================
 # СПРАВОЧНИКИ
 # =========================
+# Ниже — значения по умолчанию. Если есть лист REF_SHEET (колонки с заголовками
+# ОБЪЕКТ / СТАТЬЯ / СПОСОБ ОПЛАТЫ / НДС / СОТРУДНИК), справочники берутся из него и
+# перечитываются в фоне раз в REF_TTL_SECONDS — без редеплоя.
+REF_SHEET = os.environ.get("REF_SHEET", "СПРАВОЧНИКИ").strip()
+REF_TTL_SECONDS = float(os.environ.get("REF_TTL_SECONDS", "300"))
+
 OBJECTS = [
     "ОКТЯБРЬСКИЙ",
     "ОБУХОВО",
@@ -82,37 +118,634 @@ VAT_VALUES = ["ДА", "НЕТ"]
 # =========================
 DEDUP_TTL_SECONDS = 6 * 60 * 60
 CONTENT_DEDUP_WINDOW_SECONDS = 30
-
-_seen_message_ids = {}   # message_id -> ts
-_seen_content = {}       # (chat_id, norm_text) -> ts
+# update_id: high-water mark + множество id в окне UPDATE_DEDUP_WINDOW ниже него (для апдейтов не по порядку)
+UPDATE_DEDUP_WINDOW = max(1, int(os.environ.get("UPDATE_DEDUP_WINDOW", "1000")))
+STATE_MEMORY_CAP = max(1, int(os.environ.get("STATE_MEMORY_CAP", "50000")))  # ключей на namespace
+
+# Состояние /new, /bulk и антидублей живёт в state store (см. STATE STORE):
+#   "new"       chat_id -> {"step": int, "data": dict, "ts": float}
+#   "bulk"      chat_id -> {"step": int, "hdr": dict, "items": list, "ts": float}
+#   "seen_mid"  chat_id:message_id -> 1
+#   "seen_text" chat_id:norm_text -> 1
+#   + high-water mark update_id (seen_update)
+# STATE_BACKEND=memory — внутри процесса (только --workers 1),
+# STATE_BACKEND=sqlite — общий файл STATE_DB, можно запускать несколько воркеров gunicorn.
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory").strip().lower()
+STATE_DB = os.environ.get("STATE_DB", "state.sqlite3").strip()
+STATE_PURGE_INTERVAL = 60  # секунд между чистками просроченного
+
+# Telegram: лимиты отправки и ретраи
+TG_CHAT_RATE = float(os.environ.get("TG_CHAT_RATE", "1"))        # сообщений/с в один чат
+TG_CHAT_BURST = float(os.environ.get("TG_CHAT_BURST", "3"))
+TG_GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", "25"))   # сообщений/с на бота
+TG_MAX_RETRIES = int(os.environ.get("TG_MAX_RETRIES", "3"))
+TG_MAX_RETRY_AFTER = 30.0
+TG_POOL_SIZE = 16
 
 # /new flow state
-_new_flow = {}           # chat_id -> {"step": int, "data": dict, "ts": float}
 NEW_FLOW_TTL = 30 * 60   # 30 минут
 
 # /bulk flow state
-_bulk_flow = {}          # chat_id -> {"step": int, "hdr": dict, "items": list, "ts": float}
 BULK_FLOW_TTL = 30 * 60  # 30 минут
 
 _sheets_service = None
+_sheets_service_lock = threading.Lock()
 _sheet_id_cache = {}     # title -> sheetId
+_sheet_ids_loaded_at = 0.0   # time.monotonic() последнего чтения метаданных
+
+# Прогрев при старте процесса (gunicorn post_fork, python main.py): клиент Sheets, все sheetId
+# одним запросом и справочники — первый апдейт после простоя не платит за это сам.
+PREWARM = _env_flag("PREWARM", "1")
+_boot_timings = {}       # этап -> секунды (cold start, видно в /metrics)
+
+# Квоты Sheets API (запросов в минуту на пользователя: по умолчанию 60 чтений и 60 записей).
+# 0 — без ограничения. SHEETS_RESERVE токенов записи/чтения остаются только для операций и /undo.
+SHEETS_READ_RPM = float(os.environ.get("SHEETS_READ_RPM", "60"))
+SHEETS_WRITE_RPM = float(os.environ.get("SHEETS_WRITE_RPM", "60"))
+SHEETS_RESERVE = float(os.environ.get("SHEETS_RESERVE", "3"))
+SHEETS_MAX_RETRIES = int(os.environ.get("SHEETS_MAX_RETRIES", "4"))
+SHEETS_BACKOFF_BASE = 0.5
+SHEETS_BACKOFF_MAX = 16.0
+
+# Транспорт Sheets: discovery — googleapiclient (по умолчанию), rest — свой тонкий клиент
+# поверх keep-alive requests.Session (gzip, узкие fields). Если rest не поднялся — discovery.
+SHEETS_TRANSPORT = os.environ.get("SHEETS_TRANSPORT", "discovery").strip().lower()
+SHEETS_API_URL = os.environ.get("SHEETS_API_URL", "https://sheets.googleapis.com").strip().rstrip("/")
+SHEETS_HTTP_TIMEOUT = float(os.environ.get("SHEETS_HTTP_TIMEOUT", "30"))
+SHEETS_POOL_SIZE = 8
+
+# максимум строк в одном values().append (большие пачки режем на чанки)
+SHEETS_APPEND_CHUNK = max(1, int(os.environ.get("SHEETS_APPEND_CHUNK", "500")))
+
+# Group commit: записи в ОПЕРАЦИИ из параллельных запросов копятся столько миллисекунд
+# и уходят одним append. 0 — писать каждую операцию сразу.
+OPS_COMMIT_WINDOW_MS = float(os.environ.get("OPS_COMMIT_WINDOW_MS", "25"))
+
+# Логи пишутся не сразу, а пачками: по LOG_FLUSH_ROWS строк или раз в LOG_FLUSH_INTERVAL секунд.
+# Если Sheets не принял пачку — строки дописываются в LOG_FALLBACK_FILE (jsonl).
+LOG_BUFFERED = _env_flag("LOG_BUFFERED", "1")
+LOG_FLUSH_ROWS = max(1, int(os.environ.get("LOG_FLUSH_ROWS", "50")))
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", "2"))
+LOG_FALLBACK_FILE = os.environ.get("LOG_FALLBACK_FILE", "logs_fallback.jsonl").strip()
+
+_log_buffer = []         # строки для ЛОГИ, ещё не отправленные в Sheets
+_log_lock = threading.Lock()
+_log_flush_lock = threading.Lock()
+_log_wakeup = threading.Event()
+_log_flusher = None
+
+# Зеркало ОПЕРАЦИИ в памяти (нужные колонки каждой строки) + индексы MessageID -> строки,
+# batch_id -> строки. Грузится один раз постранично (A:N по OPS_PAGE_ROWS строк),
+# дальше обновляется по updatedRange и удалениям. На зеркале же строятся /report и др. (_ops_hooks).
+# OPS_INDEX=0 — /undo ищет строки полным чтением колонок, как раньше.
+# OPS_PARTITION=1 — строки раскладываются по листам ОПЕРАЦИИ_YYYY-MM по полю ПЕРИОД (лист
+# создаётся при первой записи в месяц); в основном листе остаются строки, записанные до разбиения.
+# Зеркало и индексы у каждого листа свои, поэтому запись и /undo читают только свой раздел.
+OPS_INDEX = _env_flag("OPS_INDEX", "1")
+OPS_PAGE_ROWS = max(100, int(os.environ.get("OPS_PAGE_ROWS", "5000")))
+OPS_PARTITION = _env_flag("OPS_PARTITION", "")
+OPS_SHEETS_TTL = float(os.environ.get("OPS_SHEETS_TTL", "300"))   # как часто перечитывать список листов-разделов
+_ops_parts = {}          # лист -> _OpsPart (зеркало листа)
+_ops_hooks = []          # fn(event, rows): event = "append" | "delete"; строки всех листов
+_ops_index_lock = threading.RLock()
+_ops_sheet_lock = threading.Lock()   # создание листов-разделов
+
+# Локальный журнал действий по чатам (SQLite): что и когда записано, чтобы /undo не читал ЛОГИ.
+# Пустой JOURNAL_DB — старый режим (поиск по листу ЛОГИ).
+JOURNAL_DB = os.environ.get("JOURNAL_DB", "journal.sqlite3").strip()
+UNDO_MAX = 20            # максимум N в /undo N
+QUICK_MAX_RECORDS = 100  # записей в одном сообщении быстрого ввода
+_journal_db = None
+_journal_lock = threading.RLock()
+
+# Outbox: одиночная операция (/new, быстрый ввод) сначала фиксируется в локальном SQLite
+# (WAL + synchronous=FULL, т.е. fsync) и сразу подтверждается пользователю; в ОПЕРАЦИИ её
+# переносит фоновый flusher пачками, по порядку. Каждая строка получает в Комментарий (N)
+# свою метку [OB-…] (её видно в таблице); по ней повторный перенос узнаёт уже дошедшие строки —
+# MessageID для этого не годится, он уникален только внутри чата.
+# После рестарта недоставленное дописывается. Пустой OUTBOX_DB — писать в Sheets сразу.
+OUTBOX_DB = os.environ.get("OUTBOX_DB", "").strip()
+OUTBOX_FLUSH_INTERVAL = float(os.environ.get("OUTBOX_FLUSH_INTERVAL", "1"))
+_outbox_db = None
+_outbox_lock = threading.RLock()         # соединение SQLite
+_outbox_flush_lock = threading.Lock()    # один перенос в Sheets за раз (и /undo ждёт его)
+_outbox_wakeup = threading.Event()
+_outbox_flusher = None
+
+# /metrics (формат Prometheus). Метрики свои у каждого процесса gunicorn.
+# METRICS_TOKEN — если задан, /metrics отдаётся только с заголовком Authorization: Bearer <token>.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "").strip()
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# =========================
+# METRICS
+# =========================
+_METRICS_HELP = {
+    "icbot_sheets_request_seconds": ("histogram", "Время запроса к Google Sheets по функциям"),
+    "icbot_sheets_wait_seconds": ("histogram", "Ожидание квоты Sheets по виду запроса и приоритету"),
+    "icbot_sheets_rows_total": ("counter", "Строк прочитано/записано в Google Sheets"),
+    "icbot_sheets_bytes_total": ("counter", "Объём данных Google Sheets (JSON без сжатия)"),
+    "icbot_telegram_request_seconds": ("histogram", "Время запроса к Telegram Bot API (с ретраями и паузами)"),
+    "icbot_telegram_bytes_total": ("counter", "Объём данных Telegram Bot API"),
+    "icbot_update_seconds": ("histogram", "Время обработки апдейта по командам/веткам"),
+    "icbot_telegram_events_total": ("counter", "События клиента Telegram: sent/throttled/retried/failed"),
+    "icbot_state_store": ("gauge", "Счётчики state store"),
+    "icbot_update_queue_depth": ("gauge", "Апдейтов в очередях ack-first"),
+    "icbot_log_buffer_rows": ("gauge", "Строк ЛОГИ, ожидающих отправки"),
+    "icbot_ops_mirror_rows": ("gauge", "Строк ОПЕРАЦИИ в зеркале"),
+    "icbot_outbox_pending_rows": ("gauge", "Операций в outbox, ещё не перенесённых в Sheets"),
+    "icbot_cold_start_seconds": ("gauge", "Этапы старта процесса: import, sheets_service, sheet_ids, ref, first_update"),
+}
+
+
+class Metrics:
+    # счётчики и гистограммы в памяти процесса; ключ — (имя, отсортированные метки)
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}   # (name, labels) -> value
+        self.hists = {}      # (name, labels) -> [bucket_counts, sum, count]
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.hists.get(key)
+            if h is None:
+                h = self.hists[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if seconds <= b:
+                    h[0][i] += 1
+            h[1] += seconds
+            h[2] += 1
+
+    def render(self, gauges=()) -> str:
+        # gauges — [(name, labels_dict, value)], снимаются в момент запроса
+        series = {}
+        with self.lock:
+            for (name, labels), v in self.counters.items():
+                series.setdefault(name, []).append(_metric_line(name, labels, v))
+            for (name, labels), (counts, total, n) in self.hists.items():
+                lines = series.setdefault(name, [])
+                for b, c in zip(self.buckets, counts):
+                    lines.append(_metric_line(name + "_bucket", labels + (("le", repr(b)),), c))
+                lines.append(_metric_line(name + "_bucket", labels + (("le", "+Inf"),), n))
+                lines.append(_metric_line(name + "_sum", labels, total))
+                lines.append(_metric_line(name + "_count", labels, n))
+        for name, labels, v in gauges:
+            series.setdefault(name, []).append(_metric_line(name, tuple(sorted(labels.items())), v))
+
+        out = []
+        for name in sorted(series):
+            kind, text = _METRICS_HELP.get(name, ("untyped", name))
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(series[name])
+        return "\n".join(out) + "\n"
+
+
+def _metric_line(name: str, labels: tuple, value) -> str:
+    if labels:
+        body = ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+        return f"{name}{{{body}}} {value}"
+    return f"{name} {value}"
+
+
+metrics = Metrics()
+_update_ctx = threading.local()   # .label — ветка process_update для icbot_update_seconds
+
+def _payload_size(values, columns: bool = False):
+    # (строк, байт) для values из/в Sheets; байты — как JSON без сжатия
+    if not values:
+        return 0, 0
+    rows = max(len(c) for c in values) if columns else len(values)
+    return rows, len(json.dumps(values, ensure_ascii=False).encode("utf-8"))
+
+def _metrics_gauges():
+    g = []
+    if _tg_client is not None:
+        for event, v in _tg_client.stats().items():
+            g.append(("icbot_telegram_events_total", {"event": event}, v))
+    if _state_store is not None:
+        for k, v in _state_store.stats().items():
+            if isinstance(v, (int, float)):
+                g.append(("icbot_state_store", {"stat": k}, v))
+    g.append(("icbot_update_queue_depth", {}, sum(q.qsize() for q in _update_queues)))
+    g.append(("icbot_log_buffer_rows", {}, len(_log_buffer)))
+    g.append(("icbot_ops_mirror_rows", {}, sum(len(p.rows) for p in list(_ops_parts.values()))))
+    if _outbox_db is not None:
+        g.append(("icbot_outbox_pending_rows", {}, outbox_pending()))
+    for phase, v in list(_boot_timings.items()):
+        g.append(("icbot_cold_start_seconds", {"phase": phase}, round(v, 6)))
+    return g
+
+# =========================
+# STATE STORE
+# =========================
+class StateStore:
+    # ключ-значение с TTL, разложенное по пространствам имён (ns)
+    def get(self, ns: str, key: str):
+        raise NotImplementedError
+
+    def set(self, ns: str, key: str, value, ttl: float) -> None:
+        raise NotImplementedError
+
+    def delete(self, ns: str, key: str) -> None:
+        raise NotImplementedError
+
+    def add(self, ns: str, key: str, ttl: float, value=1) -> bool:
+        # атомарно: True — ключа не было (или он истёк) и теперь он записан, False — уже есть
+        raise NotImplementedError
+
+    def purge(self, now_ts: float) -> None:
+        raise NotImplementedError
+
+    def seen_update(self, update_id: int) -> bool:
+        # True — этот update_id уже обрабатывали, False — новый
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {}
+
+
+class TTLCache:
+    # OrderedDict в порядке вставки: при постоянном ttl самые старые ключи всегда спереди,
+    # поэтому истекшие снимаются с головы за O(1) амортизированно, без полного обхода
+    def __init__(self, cap: int):
+        self.cap = cap
+        self.items = OrderedDict()   # key -> expires_at
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _expire(self, now_ts: float):
+        items = self.items
+        while items:
+            key, exp = next(iter(items.items()))
+            if exp > now_ts:
+                break
+            items.popitem(last=False)
+
+    def add(self, key, ttl: float) -> bool:
+        now_ts = time.time()
+        self._expire(now_ts)
+        if key in self.items:
+            self.hits += 1
+            return False
+        self.misses += 1
+        self.items[key] = now_ts + ttl
+        if len(self.items) > self.cap:
+            self.items.popitem(last=False)
+            self.evictions += 1
+        return True
+
+
+class MemoryStateStore(StateStore):
+    def __init__(self):
+        self._data = {}      # ns -> {key: (expires_at, value)}
+        self._caches = {}    # ns -> TTLCache (для add: ttl внутри одного ns постоянный)
+        self._update_wm = 0          # максимальный увиденный update_id
+        self._update_recent = set()  # update_id в окне (wm - UPDATE_DEDUP_WINDOW, wm]
+        self._update_hits = 0
+        self._update_misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, ns, key):
+        with self._lock:
+            item = self._data.get(ns, {}).get(key)
+            if not item:
+                return None
+            if item[0] <= time.time():
+                self._data[ns].pop(key, None)
+                return None
+            return item[1]
+
+    def set(self, ns, key, value, ttl):
+        with self._lock:
+            self._data.setdefault(ns, {})[key] = (time.time() + ttl, value)
+
+    def delete(self, ns, key):
+        with self._lock:
+            self._data.get(ns, {}).pop(key, None)
+
+    def add(self, ns, key, ttl, value=1):
+        with self._lock:
+            cache = self._caches.get(ns)
+            if cache is None:
+                cache = self._caches[ns] = TTLCache(STATE_MEMORY_CAP)
+            return cache.add(key, ttl)
+
+    def purge(self, now_ts):
+        with self._lock:
+            for bucket in self._data.values():
+                for k in [k for k, (exp, _) in bucket.items() if exp <= now_ts]:
+                    bucket.pop(k, None)
+            for cache in self._caches.values():
+                cache._expire(now_ts)
+
+    def seen_update(self, update_id):
+        with self._lock:
+            if update_id > self._update_wm:
+                self._update_wm = update_id
+                self._update_recent.add(update_id)
+                if len(self._update_recent) > 2 * UPDATE_DEDUP_WINDOW:
+                    floor = update_id - UPDATE_DEDUP_WINDOW
+                    self._update_recent = {u for u in self._update_recent if u > floor}
+                self._update_misses += 1
+                return False
+            if update_id <= self._update_wm - UPDATE_DEDUP_WINDOW:
+                # Telegram начинает update_id заново (случайно) после недели без апдейтов
+                print("update_id sequence reset:", self._update_wm, "->", update_id)
+                self._update_wm = update_id
+                self._update_recent = {update_id}
+                self._update_misses += 1
+                return False
+            if update_id in self._update_recent:
+                self._update_hits += 1
+                return True
+            self._update_recent.add(update_id)
+            self._update_misses += 1
+            return False
+
+    def stats(self):
+        with self._lock:
+            out = {"update_hits": self._update_hits, "update_misses": self._update_misses}
+            for ns, cache in self._caches.items():
+                out[f"{ns}_hits"] = cache.hits
+                out[f"{ns}_misses"] = cache.misses
+                out[f"{ns}_evictions"] = cache.evictions
+                out[f"{ns}_size"] = len(cache.items)
+            return out
+
+
+class SqliteStateStore(StateStore):
+    # один файл на всех воркеров gunicorn; WAL даёт параллельные чтения и короткие блокировки записи
+    def __init__(self, path: str):
+        self._path = path
+        self._local = threading.local()
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS kv (
+                ns TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires REAL NOT NULL,
+                PRIMARY KEY (ns, key)
+            );
+            CREATE INDEX IF NOT EXISTS kv_expires ON kv(expires);
+            CREATE TABLE IF NOT EXISTS updates (update_id INTEGER PRIMARY KEY);
+        """)
+        self._counters = {}
+        self._counters_lock = threading.Lock()
+
+    def _count(self, name: str, n: int = 1):
+        with self._counters_lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, ns, key):
+        row = self._conn().execute(
+            "SELECT value FROM kv WHERE ns = ? AND key = ? AND expires > ?", (ns, key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, ns, key, value, ttl):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO kv(ns, key, value, expires) VALUES (?, ?, ?, ?)",
+            (ns, key, json.dumps(value, ensure_ascii=False), time.time() + ttl),
+        )
+
+    def delete(self, ns, key):
+        self._conn().execute("DELETE FROM kv WHERE ns = ? AND key = ?", (ns, key))
+
+    def add(self, ns, key, ttl, value=1):
+        now_ts = time.time()
+        cur = self._conn().execute(
+            "INSERT INTO kv(ns, key, value, expires) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(ns, key) DO UPDATE SET value = excluded.value, expires = excluded.expires "
+            "WHERE kv.expires <= ?",
+            (ns, key, json.dumps(value, ensure_ascii=False), now_ts + ttl, now_ts),
+        )
+        added = cur.rowcount > 0
+        self._count(f"{ns}_misses" if added else f"{ns}_hits")
+        return added
+
+    def purge(self, now_ts):
+        cur = self._conn().execute("DELETE FROM kv WHERE expires <= ?", (now_ts,))
+        self._count("evictions", max(cur.rowcount, 0))
+
+    def seen_update(self, update_id):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            wm = conn.execute("SELECT MAX(update_id) FROM updates").fetchone()[0] or 0
+            if update_id <= wm - UPDATE_DEDUP_WINDOW:
+                # Telegram начинает update_id заново (случайно) после недели без апдейтов
+                print("update_id sequence reset:", wm, "->", update_id)
+                conn.execute("DELETE FROM updates")
+            dup = conn.execute("INSERT OR IGNORE INTO updates(update_id) VALUES (?)", (update_id,)).rowcount == 0
+            if not dup and update_id > wm:
+                conn.execute("DELETE FROM updates WHERE update_id <= ?", (update_id - UPDATE_DEDUP_WINDOW,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._count("update_hits" if dup else "update_misses")
+        return dup
+
+    def stats(self):
+        with self._counters_lock:
+            return dict(self._counters)
+
+
+_state_store = None
+_state_store_lock = threading.Lock()
+_state_last_purge = 0.0
+
+def state_store() -> StateStore:
+    global _state_store
+    if _state_store is None:
+        with _state_store_lock:
+            if _state_store is None:
+                if STATE_BACKEND == "sqlite":
+                    _state_store = SqliteStateStore(STATE_DB)
+                elif STATE_BACKEND == "memory":
+                    _state_store = MemoryStateStore()
+                else:
+                    raise RuntimeError(f"Unknown STATE_BACKEND '{STATE_BACKEND}'")
+    return _state_store
+
+# =========================
+# TELEGRAM CLIENT
+# =========================
+class _TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        # забирает токен (в долг, если нужно) и возвращает, сколько секунд надо подождать
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class TelegramClient:
+    # keep-alive сессия + лимиты Telegram (≈1 сообщение/с в чат, ≈30/с на бота) + ретраи по 429 retry_after
+    def __init__(self, api_url: str):
+        self.api_url = api_url
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=TG_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.global_bucket = _TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self.chat_buckets = {}   # chat_id -> _TokenBucket
+        self.lock = threading.Lock()
+        self.counters = {"sent": 0, "throttled": 0, "retried": 0, "failed": 0}
+
+    def _count(self, name: str, n: int = 1):
+        with self.lock:
+            self.counters[name] += n
+
+    def _throttle(self, chat_id):
+        with self.lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self.chat_buckets) > 5000:
+                    self.chat_buckets.clear()   # давно молчащие чаты всё равно с полным ведром
+                bucket = self.chat_buckets[chat_id] = _TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)
+        wait = max(bucket.reserve(), self.global_bucket.reserve())
+        if wait > 0:
+            self._count("throttled")
+            time.sleep(wait)
+
+    def call(self, method: str, body: str, chat_id=None, timeout: float = 20):
+        # body — уже сериализованный JSON; возвращает result или None при ошибке
+        data = body.encode("utf-8")
+        return self._timed(method, len(data), chat_id, lambda: self.session.post(
+            f"{self.api_url}/{method}",
+            data=data,
+            headers={"Content-Type": "application/json"},
+            timeout=timeout,
+        ))
+
+    def send_document(self, chat_id: int, path: str, filename: str, caption: str = "", timeout: float = 120):
+        # multipart-загрузка файла с диска; файл переоткрывается на каждый ретрай
+        def post():
+            with open(path, "rb") as f:
+                return self.session.post(
+                    f"{self.api_url}/sendDocument",
+                    data={"chat_id": str(chat_id), "caption": caption},
+                    files={"document": (filename, f, "application/octet-stream")},
+                    timeout=timeout,
+                )
+        return self._timed("sendDocument", os.path.getsize(path), chat_id, post)
+
+    def _timed(self, method: str, size: int, chat_id, post):
+        t0 = time.perf_counter()
+        result = self._call(method, post, chat_id)
+        metrics.observe("icbot_telegram_request_seconds", time.perf_counter() - t0,
+                        method=method, status="ok" if result is not None else "error")
+        metrics.inc("icbot_telegram_bytes_total", size, method=method, direction="out")
+        return result
+
+    def _call(self, method: str, post, chat_id):
+        if chat_id is not None:
+            self._throttle(chat_id)
+        for attempt in range(TG_MAX_RETRIES + 1):
+            delay = None
+            try:
+                r = post()
+                metrics.inc("icbot_telegram_bytes_total", len(r.content), method=method, direction="in")
+                if r.status_code == 200:
+                    self._count("sent")
+                    return r.json().get("result")
+                if r.status_code == 429:
+                    self._count("throttled")
+                    try:
+                        delay = float(((r.json() or {}).get("parameters") or {}).get("retry_after") or 1)
+                    except ValueError:
+                        delay = 1.0
+                    delay = min(delay, TG_MAX_RETRY_AFTER)
+                elif r.status_code >= 500:
+                    delay = 0.5 * (2 ** attempt)
+                else:
+                    print(f"telegram {method} error:", r.status_code, r.text[:300])
+                    if r.status_code == 409:
+                        print("telegram: getUpdates не работает при активном webhook — сначала deleteWebhook")
+                    break
+            except requests.RequestException as e:
+                print(f"telegram {method} error:", repr(e))
+                delay = 0.5 * (2 ** attempt)
+            if attempt < TG_MAX_RETRIES:
+                self._count("retried")
+                time.sleep(delay)
+        self._count("failed")
+        return None
+
+    def send_message(self, chat_id: int, text: str, reply_markup=None):
+        # reply_markup из kb() — уже готовая JSON-строка, вклеиваем как есть
+        body = '{"chat_id":%s,"text":%s' % (json.dumps(chat_id), json.dumps(text, ensure_ascii=False))
+        if reply_markup:
+            if not isinstance(reply_markup, str):
+                reply_markup = json.dumps(reply_markup, ensure_ascii=False)
+            body += ',"reply_markup":' + reply_markup
+        return self.call("sendMessage", body + "}", chat_id=chat_id)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counters)
+
+
+_tg_client = None
+_tg_client_lock = threading.Lock()
+
+def telegram_client() -> TelegramClient:
+    # создаём лениво, уже после fork — requests.Session нельзя делить между процессами
+    global _tg_client
+    if _tg_client is None:
+        with _tg_client_lock:
+            if _tg_client is None:
+                _tg_client = TelegramClient(TG_API)
+    return _tg_client
 
 # =========================
 # TELEGRAM HELPERS
 # =========================
+_kb_cache = {}           # раскладка -> готовый JSON reply_markup
+
 def kb(rows):
-    return {
-        "keyboard": [[{"text": x} for x in r] for r in rows],
-        "resize_keyboard": True,
-        "one_time_keyboard": True
-    }
+    key = tuple(tuple(r) for r in rows)
+    markup = _kb_cache.get(key)
+    if markup is None:
+        markup = json.dumps({
+            "keyboard": [[{"text": x} for x in r] for r in rows],
+            "resize_keyboard": True,
+            "one_time_keyboard": True
+        }, ensure_ascii=False)
+        if len(_kb_cache) < 256:
+            _kb_cache[key] = markup
+    return markup
 
 def send_message(chat_id: int, text: str, reply_markup=None) -> None:
-    payload = {"chat_id": chat_id, "text": text}
-    if reply_markup:
-        payload["reply_markup"] = reply_markup
     try:
-        requests.post(f"{TG_API}/sendMessage", json=payload, timeout=20)
+        telegram_client().send_message(chat_id, text, reply_markup)
     except Exception as e:
         print("send_message error:", repr(e))
 
@@ -120,13 +753,15 @@ def normalize_text(s: str) -> str:
     return re.sub(r"\s+", " ", (s or "")).strip().lower()
 
 def _cleanup_caches(now_ts: float) -> None:
-    to_del = [k for k, ts in _seen_message_ids.items() if now_ts - ts > DEDUP_TTL_SECONDS]
-    for k in to_del:
-        _seen_message_ids.pop(k, None)
-
-    to_del = [k for k, ts in _seen_content.items() if now_ts - ts > CONTENT_DEDUP_WINDOW_SECONDS]
-    for k in to_del:
-        _seen_content.pop(k, None)
+    # просроченное store и так не отдаёт, чистим место не чаще раза в STATE_PURGE_INTERVAL
+    global _state_last_purge
+    if now_ts - _state_last_purge < STATE_PURGE_INTERVAL:
+        return
+    _state_last_purge = now_ts
+    try:
+        state_store().purge(now_ts)
+    except Exception as e:
+        print("state purge error:", repr(e))
 
 def is_allowed_chat(chat_id: int) -> bool:
     if not ALLOWED_CHAT_IDS:
@@ -141,7 +776,10 @@ def quick_help_text():
         "ОБЪЕКТ; ТИП; СТАТЬЯ; СУММА; СПОСОБ; НДС; ПЕРИОД; СОТРУДНИК; КОММЕНТ\n\n"
         "Пример:\n"
         "ОБУХОВО; РАСХОД; КВАРТИРА; 35000; НАЛ; НЕТ; 2026-01-1; ИВАНОВ; январь\n\n"
-        "Период: YYYY-MM-1 или YYYY-MM-2\n"
+        "Можно несколько записей в одном сообщении — каждая с новой строки.\n"
+        "Запишутся, только если все строки верные; /undo отменит их все.\n"
+        + ("Все строки одного сообщения — за один месяц.\n" if OPS_PARTITION else "")
+        + "\nПериод: YYYY-MM-1 или YYYY-MM-2\n"
         "1=1–15, 2=16–31"
     )
 
@@ -156,15 +794,224 @@ def bulk_help_text():
         "3) Потом кидаешь строки сотрудников (каждая строка = 1 запись):\n"
         "Маматисойв Акмалжон - 5к\n"
         "Тогаев Шохрух 13000\n"
-        "Ахмедов Отабек = 3000\n\n"
+        "Ахмедов Отабек = 3000\n"
+        "или файл .csv / .xlsx (колонки: ФИО, сумма) — запишется сразу\n"
+        "Опечатки в ФИО исправляются по справочнику сотрудников\n\n"
         "4) Завершить и записать: /done\n"
         "Отменить пачку: /undo_bulk\n"
         "Отмена режима: /cancel"
     )
 
+# =========================
+# SHEETS SCHEDULER
+# =========================
+# Все запросы к Sheets идут через _sheets_execute: токен из ведра чтения или записи
+# (минутные квоты Google), очередь по приоритету и повтор с backoff на 429/5xx.
+PRIO_OP, PRIO_UNDO, PRIO_LOG, PRIO_BACKGROUND = 0, 1, 2, 3
+_PRIO_NAMES = {PRIO_OP: "op", PRIO_UNDO: "undo", PRIO_LOG: "log", PRIO_BACKGROUND: "background"}
+_sheets_ctx = threading.local()   # .prio — класс запросов текущего потока (по умолчанию PRIO_OP)
+
+
+class SheetsScheduler:
+    # ждущие одного ведра обслуживаются по (приоритет, очередь прихода);
+    # логи и фон не берут последние SHEETS_RESERVE токенов — они для записей и /undo
+    def __init__(self, read_rpm: float, write_rpm: float, reserve: float):
+        self.cond = threading.Condition()
+        self.reserve = reserve
+        self.buckets = {}    # kind -> [tokens, rate_per_s, burst, ts]
+        self.waiting = {}    # kind -> heap [(prio, seq)]
+        for kind, rpm in (("read", read_rpm), ("write", write_rpm)):
+            if rpm > 0:
+                burst = max(1.0, rpm / 6, reserve + 1)   # не больше ~10 секунд квоты разом
+                self.buckets[kind] = [burst, rpm / 60.0, burst, time.monotonic()]
+                self.waiting[kind] = []
+        self._seq = itertools.count()
+
+    def _refill(self, b):
+        now = time.monotonic()
+        b[0] = min(b[2], b[0] + (now - b[3]) * b[1])
+        b[3] = now
+
+    def acquire(self, kind: str, prio: int) -> float:
+        # блокирует до получения токена; возвращает, сколько секунд ждали
+        b = self.buckets.get(kind)
+        if b is None:
+            return 0.0
+        t0 = time.monotonic()
+        floor = 0 if prio <= PRIO_UNDO else self.reserve
+        ticket = (prio, next(self._seq))
+        with self.cond:
+            heap = self.waiting[kind]
+            heapq.heappush(heap, ticket)
+            try:
+                while True:
+                    self._refill(b)
+                    if heap[0] == ticket:
+                        if b[0] - 1 >= floor:
+                            b[0] -= 1
+                            return time.monotonic() - t0
+                        self.cond.wait(max(0.005, (floor + 1 - b[0]) / b[1]))
+                    else:
+                        self.cond.wait()
+            finally:
+                heap.remove(ticket)
+                heapq.heapify(heap)
+                self.cond.notify_all()
+
+    def penalize(self, kind: str):
+        # Google ответил 429 — квота уже выбрана, обнуляем ведро, чтобы притормозили все
+        b = self.buckets.get(kind)
+        if b is None:
+            return
+        with self.cond:
+            self._refill(b)
+            b[0] = min(b[0], 0.0)
+
+
+_sheets_scheduler = SheetsScheduler(SHEETS_READ_RPM, SHEETS_WRITE_RPM, SHEETS_RESERVE)
+
+def _http_status(e: Exception) -> int:
+    # статус HttpError googleapiclient (без импорта модуля); 0 — не HTTP-ошибка
+    try:
+        return int(getattr(getattr(e, "resp", None), "status", 0) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def _sheets_retryable(e: Exception, write: bool) -> bool:
+    # 429 — запрос не выполнен, повторять безопасно; 5xx и обрывы связи — только для чтений:
+    # append или deleteDimension могли успеть примениться, повтор задвоит/удалит лишнее
+    status = _http_status(e)
+    if status:
+        return status == 429 or (status >= 500 and not write)
+    return isinstance(e, OSError) and not write
+
+def _sheets_execute(fn: str, req, sent=None, columns: bool = False, write: bool = False, prio=None):
+    # единая точка .execute() для Sheets: квота, приоритет, ретраи, время, строки и байты
+    if prio is None:
+        prio = getattr(_sheets_ctx, "prio", PRIO_OP)
+    kind = "write" if write else "read"
+    for attempt in range(SHEETS_MAX_RETRIES + 1):
+        waited = _sheets_scheduler.acquire(kind, prio)
+        metrics.observe("icbot_sheets_wait_seconds", waited, kind=kind, prio=_PRIO_NAMES[prio])
+        t0 = time.perf_counter()
+        try:
+            resp = req.execute()
+        except Exception as e:
+            retry = attempt < SHEETS_MAX_RETRIES and _sheets_retryable(e, write)
+            metrics.observe("icbot_sheets_request_seconds", time.perf_counter() - t0,
+                            fn=fn, status="retry" if retry else "error")
+            if not retry:
+                raise
+            if _http_status(e) == 429:
+                _sheets_scheduler.penalize(kind)
+            delay = min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * (2 ** attempt))
+            print(f"sheets {fn} retry {attempt + 1}:", repr(e))
+            time.sleep(random.uniform(delay / 2, delay))
+            continue
+        metrics.observe("icbot_sheets_request_seconds", time.perf_counter() - t0, fn=fn, status="ok")
+        break
+    if sent:
+        rows, size = _payload_size(sent)
+        metrics.inc("icbot_sheets_rows_total", rows, fn=fn, direction="write")
+        metrics.inc("icbot_sheets_bytes_total", size, fn=fn, direction="write")
+    got = (resp or {}).get("values")
+    if got is None and (resp or {}).get("valueRanges"):
+        got = [r for vr in resp["valueRanges"] for r in vr.get("values", [])]
+    if got:
+        rows, size = _payload_size(got, columns)
+        metrics.inc("icbot_sheets_rows_total", rows, fn=fn, direction="read")
+        metrics.inc("icbot_sheets_bytes_total", size, fn=fn, direction="read")
+    return resp
+
 # =========================
 # GOOGLE SHEETS HELPERS
 # =========================
+class SheetsHttpError(Exception):
+    # как googleapiclient.errors.HttpError: статус в .resp.status (см. _http_status)
+    def __init__(self, status: int, text: str):
+        super().__init__(f"Sheets HTTP {status}: {text[:300]}")
+        self.resp = SimpleNamespace(status=status)
+
+
+class _RestRequest:
+    def __init__(self, client, method: str, path: str, params: dict, body=None):
+        self.client = client
+        self.method = method
+        self.path = path
+        self.params = params
+        self.body = body
+
+    def execute(self, **kwargs):
+        return self.client._request(self.method, self.path, self.params, self.body)
+
+
+class _SheetsRestValues:
+    def __init__(self, client):
+        self.client = client
+
+    def append(self, spreadsheetId, range, body, valueInputOption="USER_ENTERED",
+               insertDataOption="INSERT_ROWS", fields="updates(updatedRange,updatedRows)"):
+        return _RestRequest(self.client, "POST", f"{spreadsheetId}/values/{quote(range, safe='')}:append", {
+            "valueInputOption": valueInputOption, "insertDataOption": insertDataOption, "fields": fields,
+        }, body)
+
+    def get(self, spreadsheetId, range, majorDimension="ROWS", fields="values"):
+        return _RestRequest(self.client, "GET", f"{spreadsheetId}/values/{quote(range, safe='')}", {
+            "majorDimension": majorDimension, "fields": fields,
+        })
+
+    def batchGet(self, spreadsheetId, ranges, majorDimension="ROWS", fields="valueRanges(values)",
+                 valueRenderOption="FORMATTED_VALUE", dateTimeRenderOption="SERIAL_NUMBER"):
+        return _RestRequest(self.client, "GET", f"{spreadsheetId}/values:batchGet", {
+            "ranges": list(ranges), "majorDimension": majorDimension, "fields": fields,
+            "valueRenderOption": valueRenderOption, "dateTimeRenderOption": dateTimeRenderOption,
+        })
+
+
+class SheetsRest:
+    # тонкий клиент REST v4 ровно под вызовы бота; цепочка как у googleapiclient
+    # (spreadsheets().values().append(...).execute()), поэтому вызывающий код тот же
+    def __init__(self, session, base_url: str = SHEETS_API_URL):
+        self.session = session
+        self.base_url = base_url.rstrip("/")
+        self._values = _SheetsRestValues(self)
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self._values
+
+    def get(self, spreadsheetId, fields="sheets(properties(sheetId,title))"):
+        return _RestRequest(self, "GET", spreadsheetId, {"fields": fields})
+
+    def batchUpdate(self, spreadsheetId, body, fields="replies"):
+        return _RestRequest(self, "POST", f"{spreadsheetId}:batchUpdate", {"fields": fields}, body)
+
+    def _request(self, method: str, path: str, params: dict, body=None):
+        data = None
+        headers = {}
+        if body is not None:
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            headers["Content-Type"] = "application/json; charset=utf-8"
+        r = self.session.request(method, f"{self.base_url}/v4/spreadsheets/{path}",
+                                 params=params, data=data, headers=headers, timeout=SHEETS_HTTP_TIMEOUT)
+        if r.status_code >= 300:
+            raise SheetsHttpError(r.status_code, r.text)
+        return r.json() if r.content else {}
+
+
+def _sheets_rest_session(creds):
+    # AuthorizedSession сам обновляет access token по service account перед истечением
+    from google.auth.transport.requests import AuthorizedSession
+    session = AuthorizedSession(creds)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=SHEETS_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = "mini-ic-bot (gzip)"   # Google отдаёт gzip, если в UA есть "gzip"
+    session.headers["Accept-Encoding"] = "gzip"
+    return session
+
 def build_sheets_service():
     global _sheets_service
     if _sheets_service is not None:
@@ -173,64 +1020,146 @@ def build_sheets_service():
     if not GOOGLE_SA_JSON:
         raise RuntimeError("GOOGLE_SA_JSON is empty")
 
-    sa_info = json.loads(GOOGLE_SA_JSON)
-    creds = service_account.Credentials.from_service_account_info(sa_info, scopes=SCOPES)
-    _sheets_service = build("sheets", "v4", credentials=creds, cache_discovery=False)
+    with _sheets_service_lock:
+        if _sheets_service is not None:
+            return _sheets_service
+        t0 = time.perf_counter()
+        from google.oauth2 import service_account
+
+        sa_info = json.loads(GOOGLE_SA_JSON)
+        creds = service_account.Credentials.from_service_account_info(sa_info, scopes=SCOPES)
+        if SHEETS_TRANSPORT == "rest":
+            try:
+                _sheets_service = SheetsRest(_sheets_rest_session(creds), SHEETS_API_URL)
+            except Exception as e:
+                print("sheets rest transport error, fallback to discovery:", repr(e))
+        if _sheets_service is None:
+            from googleapiclient.discovery import build
+            _sheets_service = build("sheets", "v4", credentials=creds, cache_discovery=False)
+        _boot_timings["sheets_service"] = time.perf_counter() - t0
     return _sheets_service
 
+def _load_sheet_ids(service) -> dict:
+    # все title -> sheetId одним запросом метаданных; удалённые листы из кэша убираем
+    global _sheet_ids_loaded_at
+    meta = _sheets_execute("_load_sheet_ids", service.spreadsheets().get(
+        spreadsheetId=SPREADSHEET_ID,
+        fields="sheets(properties(sheetId,title))"
+    ))
+    ids = {}
+    for sh in meta.get("sheets", []):
+        props = sh.get("properties", {})
+        if props.get("title") is not None:
+            ids[props["title"]] = int(props.get("sheetId"))
+    _sheet_id_cache.update(ids)
+    for t in set(_sheet_id_cache) - set(ids):
+        _sheet_id_cache.pop(t, None)
+    _sheet_ids_loaded_at = time.monotonic()
+    return ids
+
 def _get_sheet_id(service, title: str) -> int:
     if title in _sheet_id_cache:
         return _sheet_id_cache[title]
 
-    meta = service.spreadsheets().get(
-        spreadsheetId=SPREADSHEET_ID,
-        fields="sheets(properties(sheetId,title))"
-    ).execute()
+    sid = _load_sheet_ids(service).get(title)
+    if sid is None:
+        raise RuntimeError(f"Sheet '{title}' not found")
+    return sid
 
-    for sh in meta.get("sheets", []):
-        props = sh.get("properties", {})
-        if props.get("title") == title:
-            sid = int(props.get("sheetId"))
-            _sheet_id_cache[title] = sid
-            return sid
+def _a1(sheet_name: str) -> str:
+    # имя листа для A1-диапазона: в кавычках — у разделов ОПЕРАЦИИ_YYYY-MM есть дефис
+    return "'" + sheet_name.replace("'", "''") + "'"
 
-    raise RuntimeError(f"Sheet '{title}' not found")
+def _range_sheet(updated_range: str) -> str:
+    # "'ОПЕРАЦИИ_2026-01'!A12:N13" -> "ОПЕРАЦИИ_2026-01"
+    name = (updated_range or "").rpartition("!")[0]
+    if len(name) >= 2 and name[0] == name[-1] == "'":
+        name = name[1:-1].replace("''", "'")
+    return name
 
 def append_row(sheet_name: str, row: list):
+    # возвращает updatedRange, например "'ОПЕРАЦИИ'!A120:N120"
+    return append_rows(sheet_name, [row])[0]
+
+def append_rows(sheet_name: str, rows: list):
+    # один values().append на каждые SHEETS_APPEND_CHUNK строк; возвращает список updatedRange по чанкам
     svc = build_sheets_service()
-    svc.spreadsheets().values().append(
-        spreadsheetId=SPREADSHEET_ID,
-        range=sheet_name,
-        valueInputOption="USER_ENTERED",
-        insertDataOption="INSERT_ROWS",
-        body={"majorDimension": "ROWS", "values": [row]},
-    ).execute()
+    ranges = []
+    for i in range(0, len(rows), SHEETS_APPEND_CHUNK):
+        chunk = rows[i:i + SHEETS_APPEND_CHUNK]
+        resp = _sheets_execute("append_rows", svc.spreadsheets().values().append(
+            spreadsheetId=SPREADSHEET_ID,
+            range=_a1(sheet_name),
+            valueInputOption="USER_ENTERED",
+            insertDataOption="INSERT_ROWS",
+            body={"majorDimension": "ROWS", "values": chunk},
+        ), sent=chunk, write=True, prio=PRIO_LOG if sheet_name == SHEET_LOGS else None)
+        updated = ((resp or {}).get("updates") or {}).get("updatedRange", "")
+        if is_ops_sheet(sheet_name):
+            _ops_index_on_append(sheet_name, updated, chunk)
+        ranges.append(updated)
+    return ranges
+
+_updated_range_re = re.compile(r"![A-Z]+(\d+)(?::[A-Z]+(\d+))?$")
+
+def range_rows(updated_range: str):
+    # "'ОПЕРАЦИИ'!A120:N125" -> (120, 125); None, если распарсить не удалось
+    m = _updated_range_re.search(updated_range or "")
+    if not m:
+        return None
+    first = int(m.group(1))
+    last = int(m.group(2) or first)
+    return first, last
 
 def read_sheet_rows(sheet_name: str, rng: str):
     svc = build_sheets_service()
-    resp = svc.spreadsheets().values().get(
+    resp = _sheets_execute("read_sheet_rows", svc.spreadsheets().values().get(
         spreadsheetId=SPREADSHEET_ID,
-        range=f"{sheet_name}!{rng}",
+        range=f"{_a1(sheet_name)}!{rng}",
         majorDimension="ROWS"
-    ).execute()
+    ))
     return resp.get("values", [])
 
 def read_column(sheet_name: str, col: str):
     svc = build_sheets_service()
-    resp = svc.spreadsheets().values().get(
+    resp = _sheets_execute("read_column", svc.spreadsheets().values().get(
         spreadsheetId=SPREADSHEET_ID,
-        range=f"{sheet_name}!{col}",
+        range=f"{_a1(sheet_name)}!{col}",
         majorDimension="COLUMNS"
-    ).execute()
+    ), columns=True)
     cols = resp.get("values", [])
     return cols[0] if cols and cols[0] else []
 
+def read_sheet_columns(sheet_name: str, rng: str):
+    svc = build_sheets_service()
+    resp = _sheets_execute("read_sheet_columns", svc.spreadsheets().values().get(
+        spreadsheetId=SPREADSHEET_ID,
+        range=f"{_a1(sheet_name)}!{rng}",
+        majorDimension="COLUMNS"
+    ), columns=True)
+    return resp.get("values", [])
+
+def read_ranges(ranges: list, render: str = "UNFORMATTED_VALUE"):
+    # несколько маленьких диапазонов одним values().batchGet -> список списков строк.
+    # По умолчанию числа — без форматирования ("1 000,00" зависит от локали таблицы и дольше
+    # разбирается), даты — строкой, как их видит человек (иначе придут серийными номерами).
+    # FORMATTED_VALUE — как в таблице (выгрузка для людей)
+    svc = build_sheets_service()
+    resp = _sheets_execute("read_ranges", svc.spreadsheets().values().batchGet(
+        spreadsheetId=SPREADSHEET_ID,
+        ranges=ranges,
+        majorDimension="ROWS",
+        valueRenderOption=render,
+        dateTimeRenderOption="FORMATTED_STRING",
+    ))
+    return [vr.get("values", []) for vr in resp.get("valueRanges", [])]
+
 def delete_row(sheet_name: str, row_number_1based: int):
     svc = build_sheets_service()
     sid = _get_sheet_id(svc, sheet_name)
     start = row_number_1based - 1
     end = row_number_1based
-    svc.spreadsheets().batchUpdate(
+    _sheets_execute("delete_row", svc.spreadsheets().batchUpdate(
         spreadsheetId=SPREADSHEET_ID,
         body={
             "requests": [
@@ -246,7 +1175,9 @@ def delete_row(sheet_name: str, row_number_1based: int):
                 }
             ]
         }
-    ).execute()
+    ), write=True)
+    if is_ops_sheet(sheet_name):
+        _ops_index_on_delete(sheet_name, [row_number_1based])
 
 def delete_rows(sheet_name: str, row_numbers_1based: list[int]):
     # удаляем с конца, чтобы индексы не съезжали
@@ -268,10 +1199,338 @@ def delete_rows(sheet_name: str, row_numbers_1based: list[int]):
                 }
             }
         })
-    svc.spreadsheets().batchUpdate(
+    _sheets_execute("delete_rows", svc.spreadsheets().batchUpdate(
         spreadsheetId=SPREADSHEET_ID,
         body={"requests": reqs}
-    ).execute()
+    ), write=True)
+    if is_ops_sheet(sheet_name):
+        _ops_index_on_delete(sheet_name, row_numbers_1based)
+
+# =========================
+# OPS INDEX
+# =========================
+OpRow = namedtuple("OpRow", "uid dt object type article amount pay_type period employee mid comment batch")
+
+_batch_tag_re = re.compile(r"\[([A-Z]+-\d[^\]]*)\]")
+_ops_uid = itertools.count(1)   # стабильный id строки зеркала (номер строки меняется после удалений)
+
+def _ops_key(mid, comment):
+    m = _batch_tag_re.search(str(comment or ""))
+    return str(mid or "").strip(), (m.group(1) if m else "")
+
+def _to_amount(v):
+    if isinstance(v, (int, float)):
+        return float(v)
+    try:
+        return float(str(v or "").replace("\xa0", "").replace(" ", "").replace(",", "."))
+    except ValueError:
+        return None
+
+def _op_from_values(v) -> OpRow:
+    # v — значения колонок A..N одной строки (как в _op_row или как прочитано из таблицы)
+    v = [x if isinstance(x, (int, float)) else str(x or "") for x in v] + [""] * (14 - len(v))
+    mid, batch = _ops_key(v[12], v[13])
+    return OpRow(
+        next(_ops_uid),
+        str(v[0]),
+        sys.intern(str(v[1]).strip()),
+        sys.intern(str(v[2]).strip()),
+        sys.intern(str(v[3]).strip()),
+        _to_amount(v[4]),
+        sys.intern(str(v[5]).strip()),
+        sys.intern(str(v[8]).strip()),
+        str(v[9]).strip(),
+        mid,
+        str(v[13]),
+        batch,
+    )
+
+def iter_sheet_pages(sheet_name: str, first_col: str, last_col: str, page_rows: int = OPS_PAGE_ROWS, pages_per_call: int = 4, start_row: int = 1,
+                     render: str = "UNFORMATTED_VALUE"):
+    # постраничное чтение: (номер первой строки страницы, строки); несколько страниц за один batchGet.
+    # Пустые строки в конце страницы Sheets обрезает, поэтому ориентируемся на номер первой строки.
+    row = start_row
+    while True:
+        ranges = [
+            f"{_a1(sheet_name)}!{first_col}{row + k * page_rows}:{last_col}{row + (k + 1) * page_rows - 1}"
+            for k in range(pages_per_call)
+        ]
+        pages = read_ranges(ranges, render)
+        last = max((k for k, p in enumerate(pages) if p), default=-1)
+        for k in range(last + 1):
+            if pages[k]:
+                yield row + k * page_rows, pages[k]
+        if last < pages_per_call - 1:
+            return
+        row += pages_per_call * page_rows
+
+def iter_ops_pages(period_query: str = "*", page_rows: int = OPS_PAGE_ROWS, render: str = "UNFORMATTED_VALUE"):
+    # постраничное чтение всех листов ОПЕРАЦИИ, где могут быть строки периода: (лист, первая строка, строки)
+    for sheet in ops_sheets(period_query):
+        for start, page in iter_sheet_pages(sheet, "A", "N", page_rows, render=render):
+            yield sheet, start, page
+
+# =========================
+# OPS PARTITIONS (ОПЕРАЦИИ_YYYY-MM)
+# =========================
+_ops_part_re = re.compile("^" + re.escape(SHEET_OPS) + r"_(\d{4}-\d{2})$")
+_ops_period_month_re = re.compile(r"^(\d{4}-\d{2})-[12]$")
+
+def is_ops_sheet(title: str) -> bool:
+    return title == SHEET_OPS or bool(OPS_PARTITION and _ops_part_re.match(title))
+
+def ops_sheet_for(period) -> str:
+    # лист для строки с этим ПЕРИОДом
+    m = _ops_period_month_re.match(str(period or "").strip())
+    if not OPS_PARTITION or not m:
+        return SHEET_OPS
+    return f"{SHEET_OPS}_{m.group(1)}"
+
+def ops_sheets(period_query: str = "*") -> list:
+    # листы, где могут быть строки периода (YYYY-MM-N / YYYY-MM / YYYY / *): основной + разделы по месяцам
+    if not OPS_PARTITION:
+        return [SHEET_OPS]
+    month = "" if period_query == "*" else period_query[:7]
+    titles = dict(_sheet_id_cache)
+    age = time.monotonic() - _sheet_ids_loaded_at
+    # раздел могли создать в другом процессе: перечитываем по TTL, а если нужного месяца
+    # нет в кэше — сразу (но не чаще раза в 10 с, чтобы пустые месяцы не дёргали метаданные)
+    missing = len(month) == 7 and f"{SHEET_OPS}_{month}" not in titles and age > 10
+    if not titles or age > OPS_SHEETS_TTL or missing:
+        titles = _load_sheet_ids(build_sheets_service())
+    parts = []
+    for t in titles:
+        m = _ops_part_re.match(t)
+        if m and m.group(1).startswith(month):
+            parts.append(t)
+    return ([SHEET_OPS] if SHEET_OPS in titles else []) + sorted(parts)
+
+def ensure_ops_sheet(title: str) -> str:
+    # раздел создаётся при первой записи в месяц; заголовки из основного листа пишутся тем же
+    # batchUpdate (свой sheetId), чтобы соседний процесс не успел дописать строку выше них
+    if title == SHEET_OPS or title in _sheet_id_cache:
+        return title
+    with _ops_sheet_lock:
+        svc = build_sheets_service()
+        if title in _sheet_id_cache or title in _load_sheet_ids(svc):
+            return title
+        header = read_sheet_rows(SHEET_OPS, "A1:N1") if SHEET_OPS in _sheet_id_cache else []
+        sid = random.randrange(1, 2 ** 31 - 1)
+        reqs = [{"addSheet": {"properties": {"sheetId": sid, "title": title}}}]
+        if header:
+            reqs.append({"appendCells": {
+                "sheetId": sid,
+                "fields": "userEnteredValue",
+                "rows": [{"values": [{"userEnteredValue": {"stringValue": str(x)}} for x in header[0]]}],
+            }})
+        try:
+            _sheets_execute("add_sheet", svc.spreadsheets().batchUpdate(
+                spreadsheetId=SPREADSHEET_ID,
+                body={"requests": reqs},
+            ), write=True)
+        except Exception:
+            # лист мог только что создать другой процесс
+            if title in _load_sheet_ids(svc):
+                return title
+            raise
+        _sheet_id_cache[title] = sid
+        with _ops_index_lock:
+            part = _ops_part(title)
+            if not part.loaded:
+                part.rows = [_op_from_values(header[0])] if header else []
+                _ops_index_rebuild_maps(part)
+                part.loaded = True
+                _ops_run_hooks("append", part.rows)
+        print("ops partition created:", title)
+        return title
+
+# =========================
+# OPS MIRROR (по листам)
+# =========================
+# Чтение таблицы (перечит листа, сверка перед удалением) идёт без _ops_index_lock: под ней только
+# подмена rows и карт, иначе запись в ОПЕРАЦИИ ждала бы постраничного чтения. Поэтому у листа есть
+# gen — растёт при удалении строк и сбросе: номера строк, прочитанные до этого, уже не годятся.
+# Дозапись номеров не сдвигает; пока лист перечитывается, её спаны копятся в pending.
+class _OpsPart:
+    # зеркало одного листа: rows[i] — строка i+1; MessageID / batch_id -> [номер строки, ...] по возрастанию
+    __slots__ = ("title", "rows", "by_mid", "by_batch", "loaded", "gen", "pending", "load_lock")
+
+    def __init__(self, title: str):
+        self.title = title
+        self.rows = []
+        self.by_mid = {}
+        self.by_batch = {}
+        self.loaded = False
+        self.gen = 0
+        self.pending = None          # [((первая, последняя строка), [значения]), ...] во время перечитывания
+        self.load_lock = threading.Lock()   # один перечит листа за раз
+
+def _ops_part(sheet: str) -> _OpsPart:
+    with _ops_index_lock:
+        part = _ops_parts.get(sheet)
+        if part is None:
+            part = _ops_parts[sheet] = _OpsPart(sheet)
+        return part
+
+def _ops_index_rebuild_maps(part: _OpsPart):
+    part.by_mid.clear()
+    part.by_batch.clear()
+    for i, r in enumerate(part.rows):
+        if r.mid:
+            part.by_mid.setdefault(r.mid, []).append(i + 1)
+        if r.batch:
+            part.by_batch.setdefault(r.batch, []).append(i + 1)
+
+def _ops_run_hooks(event: str, rows: list):
+    for fn in _ops_hooks:
+        try:
+            fn(event, rows)
+        except Exception as e:
+            print("ops hook error:", getattr(fn, "__name__", fn), repr(e))
+
+def _ops_index_load(part: _OpsPart):
+    # перечит листа; подписчикам — старые строки листа как "delete", новые как "append"
+    with part.load_lock:
+        for attempt in range(3):
+            with _ops_index_lock:
+                if part.loaded:
+                    return   # пока ждали load_lock, лист перечитал другой поток
+                gen = part.gen
+                part.pending = []
+            t0 = time.time()
+            rows = []
+            try:
+                for start, page in iter_sheet_pages(part.title, "A", "N"):
+                    while len(rows) < start - 1:
+                        rows.append(_op_from_values([]))
+                    rows.extend(_op_from_values(v) for v in page)
+            finally:
+                with _ops_index_lock:
+                    pending, part.pending = part.pending, None
+            with _ops_index_lock:
+                # дозаписи за время чтения: уже прочитанные пропускаем, более поздние добавляем
+                ok = part.gen == gen
+                for (first, last), values in pending if ok else ():
+                    if last <= len(rows):
+                        continue
+                    if first != len(rows) + 1:
+                        ok = False
+                        break
+                    rows.extend(_op_from_values(v) for v in values)
+                if not ok:
+                    print("ops index changed while loading, retrying:", part.title)
+                    continue
+                if part.loaded:
+                    return   # лист только что создан нами же (ensure_ops_sheet) — его строки свежее
+                old, part.rows = part.rows, rows
+                _ops_index_rebuild_maps(part)
+                part.loaded = True
+                if old:
+                    _ops_run_hooks("delete", old)
+                _ops_run_hooks("append", rows)
+            print(f"ops index loaded: {part.title} {len(rows)} rows in {time.time() - t0:.2f}s")
+            return
+    raise RuntimeError(f"лист {part.title} меняется быстрее, чем перечитывается")
+
+def _ops_part_ready(sheet: str) -> _OpsPart:
+    # не вызывать под _ops_index_lock: перечит листа идёт без неё
+    part = _ops_part(sheet)
+    if not part.loaded:
+        _ops_index_load(part)
+    return part
+
+def ops_mirror():
+    # зеркало всех листов ОПЕРАЦИИ (каждый грузится при первом обращении) -> {лист: _OpsPart};
+    # менять снаружи нельзя
+    for sheet in ops_sheets():
+        _ops_part_ready(sheet)
+    return _ops_parts
+
+def _ops_index_invalidate(sheet: str = None):
+    # None — все листы
+    with _ops_index_lock:
+        for part in _ops_parts.values():
+            if sheet is None or part.title == sheet:
+                part.loaded = False
+                part.gen += 1
+
+def _ops_index_on_append(sheet: str, updated_range: str, rows: list):
+    with _ops_index_lock:
+        part = _ops_parts.get(sheet)
+        if part is None:
+            return
+        span = range_rows(updated_range)
+        if not part.loaded:
+            if part.pending is not None:
+                if span:
+                    part.pending.append((span, rows))
+                else:
+                    part.gen += 1   # куда легли строки, неизвестно — перечит начнётся заново
+            return
+        if not span or span[0] != len(part.rows) + 1 or span[1] - span[0] + 1 != len(rows):
+            # в таблицу писал кто-то ещё (или ответ без updatedRange) — перечитаем при следующем обращении
+            _ops_index_invalidate(sheet)
+            return
+        added = [_op_from_values(r) for r in rows]
+        for r in added:
+            part.rows.append(r)
+            rn = len(part.rows)
+            if r.mid:
+                part.by_mid.setdefault(r.mid, []).append(rn)
+            if r.batch:
+                part.by_batch.setdefault(r.batch, []).append(rn)
+        _ops_run_hooks("append", added)
+
+def _ops_index_on_delete(sheet: str, row_numbers: list):
+    with _ops_index_lock:
+        part = _ops_parts.get(sheet)
+        if part is None or not part.loaded:
+            return
+        if any(rn < 1 or rn > len(part.rows) for rn in row_numbers):
+            _ops_index_invalidate(sheet)
+            return
+        # del из списка сдвигает номера всех строк ниже — как и deleteDimension в таблице
+        removed = []
+        for rn in sorted(set(row_numbers), reverse=True):
+            removed.append(part.rows[rn - 1])
+            del part.rows[rn - 1]
+        part.gen += 1
+        _ops_index_rebuild_maps(part)
+        _ops_run_hooks("delete", removed)
+
+def _ops_index_verify(part: _OpsPart, gen: int, n: int, check_ranges: list, check) -> bool:
+    # дешёвая проверка дрейфа: последняя известная (на момент поиска, n строк) строка совпадает
+    # с индексом, а следующая пустая или дописана нами же после поиска; заодно одним batchGet
+    # проверяем сами строки, которые собираемся удалять
+    lo = max(n, 1)
+    got = read_ranges([f"{_a1(part.title)}!M{lo}:N{n + 1}"] + check_ranges)
+    tail = got[0]
+    with _ops_index_lock:
+        if part.gen != gen or not part.loaded:
+            return False   # строки удаляли или лист сбросили — найденные номера устарели
+        for i in range(n + 2 - lo):
+            v = tail[i] if i < len(tail) else []
+            rn = lo + i
+            if rn <= len(part.rows):
+                if _ops_key(v[0] if v else "", v[1] if len(v) > 1 else "") != (part.rows[rn - 1].mid, part.rows[rn - 1].batch):
+                    return False
+            elif any(str(x).strip() for x in v):
+                return False
+        return check(got[1:])
+
+def _ops_index_find(sheet: str, lookup, check_ranges_fn, check_fn, missing):
+    # ищем по индексу листа и сверяемся с таблицей; при расхождении — один перечит листа и повтор.
+    # Не сошлось и после перечитывания — отдаём missing: непроверенные строки удалять нельзя
+    for attempt in range(2):
+        part = _ops_part_ready(sheet)
+        with _ops_index_lock:
+            gen, n, found = part.gen, len(part.rows), lookup(part)
+        if _ops_index_verify(part, gen, n, check_ranges_fn(found), lambda got: check_fn(found, got)):
+            return found
+        print("ops index drift, reloading:", sheet)
+        _ops_index_invalidate(sheet)
+    print("ops index still drifting, giving up:", sheet)
+    return missing
 
 # =========================
 # LOGS
@@ -290,12 +1549,62 @@ def log_event(chat_id, user_id, username, full_name, message_id, text, status, e
         str(error_text or ""),
         "TELEGRAM",
     ]
+    if LOG_BUFFERED:
+        _log_enqueue(row)
+        return
     try:
         append_row(SHEET_LOGS, row)
     except Exception as e:
         print("log_event error:", repr(e))
 
+def _log_enqueue(row: list):
+    with _log_lock:
+        _log_buffer.append(row)
+        full = len(_log_buffer) >= LOG_FLUSH_ROWS
+    _start_log_flusher()
+    if full:
+        _log_wakeup.set()
+
+def _start_log_flusher():
+    global _log_flusher
+    if _log_flusher is not None:
+        return
+    with _log_lock:
+        if _log_flusher is not None:
+            return
+        _log_flusher = threading.Thread(target=_log_flusher_loop, name="log-flusher", daemon=True)
+        _log_flusher.start()
+
+def _log_flusher_loop():
+    while True:
+        _log_wakeup.wait(LOG_FLUSH_INTERVAL)
+        _log_wakeup.clear()
+        flush_logs()
+
+def flush_logs():
+    # один flush за раз, чтобы строки попадали в ЛОГИ в исходном порядке
+    with _log_flush_lock:
+        with _log_lock:
+            rows = _log_buffer[:]
+            _log_buffer.clear()
+        if not rows:
+            return
+        try:
+            append_rows(SHEET_LOGS, rows)
+        except Exception as e:
+            print("log flush error:", repr(e))
+            _log_to_fallback(rows)
+
+def _log_to_fallback(rows: list):
+    try:
+        with open(LOG_FALLBACK_FILE, "a", encoding="utf-8") as f:
+            for r in rows:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    except Exception as e:
+        print("log fallback error:", repr(e), "lost rows:", len(rows))
+
 def get_last_written_message_id_from_logs(chat_id: int):
+    flush_logs()
     rows = read_sheet_rows(SHEET_LOGS, "A:J")
     if not rows:
         return None
@@ -311,6 +1620,7 @@ def get_last_written_message_id_from_logs(chat_id: int):
     return None
 
 def get_last_bulk_batch_id(chat_id: int):
+    flush_logs()
     rows = read_sheet_rows(SHEET_LOGS, "A:J")
     if not rows:
         return None
@@ -320,16 +1630,141 @@ def get_last_bulk_batch_id(chat_id: int):
             r_status = str(r[7]).strip() if len(r) > 7 else ""
             r_err = str(r[8]).strip() if len(r) > 8 else ""
             # batch_id кладём в error_text для простоты
-            if r_chat == str(chat_id) and r_status == "BULK_WRITE OK" and r_err:
+            if r_chat == str(chat_id) and r_status in ("BULK_WRITE OK", "BULK_WRITE PARTIAL") and r_err:
                 return r_err
         except:
             continue
     return None
 
-def find_row_by_message_id_in_ops(target_message_id: str):
+# =========================
+# JOURNAL (/undo)
+# =========================
+def _journal():
+    global _journal_db
+    with _journal_lock:
+        if _journal_db is None:
+            conn = sqlite3.connect(JOURNAL_DB, timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS journal (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,          -- op | bulk | quick (несколько записей одним сообщением)
+                    key TEXT NOT NULL,           -- MessageID для op, batch_id для bulk и quick
+                    first_row INTEGER,
+                    last_row INTEGER,
+                    ts REAL NOT NULL,
+                    undone INTEGER NOT NULL DEFAULT 0,
+                    sheet TEXT                   -- лист ОПЕРАЦИИ; NULL — искать во всех
+                );
+                CREATE INDEX IF NOT EXISTS journal_last ON journal(chat_id, kind, undone, ts);
+                CREATE TABLE IF NOT EXISTS journal_meta (name TEXT PRIMARY KEY, value TEXT);
+            """)
+            if "sheet" not in {c[1] for c in conn.execute("PRAGMA table_info(journal)")}:
+                conn.execute("ALTER TABLE journal ADD COLUMN sheet TEXT")   # журнал от старой версии
+            _journal_db = conn
+        return _journal_db
+
+def journal_record(chat_id, kind: str, key, ranges=None, ts=None, sheet=None):
+    spans = [sp for sp in (range_rows(r) for r in (ranges or [])) if sp]
+    first = min(a for a, _ in spans) if spans else None
+    last = max(b for _, b in spans) if spans else None
+    if sheet is None:
+        # лист берём из updatedRange; записи в разные разделы — без листа
+        sheets = {_range_sheet(r) for r in (ranges or []) if r}
+        sheet = sheets.pop() if len(sheets) == 1 else None
+    try:
+        with _journal_lock:
+            _journal().execute(
+                "INSERT INTO journal(chat_id, kind, key, first_row, last_row, ts, sheet) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (str(chat_id), kind, str(key or ""), first, last, ts or time.time(), sheet),
+            )
+    except Exception as e:
+        print("journal_record error:", repr(e))
+
+def journal_last(chat_id, kinds: tuple, n: int = 1):
+    # последние n неотменённых записей чата нужных видов: [(id, kind, key, sheet), ...], свежие первыми
+    _journal_ensure_rebuilt()
+    marks = ", ".join("?" for _ in kinds)
+    with _journal_lock:
+        return _journal().execute(
+            f"SELECT id, kind, key, sheet FROM journal WHERE chat_id = ? AND kind IN ({marks}) AND undone = 0 "
+            "ORDER BY ts DESC, id DESC LIMIT ?",
+            (str(chat_id), *kinds, int(n)),
+        ).fetchall()
+
+def journal_mark_undone(entry_ids: list):
+    if not entry_ids:
+        return
+    with _journal_lock:
+        _journal().executemany("UPDATE journal SET undone = 1 WHERE id = ?", [(i,) for i in entry_ids])
+
+_undo_mid_re = re.compile(r"mid=(\S+)")
+_undo_batch_re = re.compile(r"batch=(\S+)")
+
+def _journal_ensure_rebuilt():
+    # холодный старт (пустой файл журнала): один раз восстанавливаем журнал из листа ЛОГИ
+    with _journal_lock:
+        conn = _journal()
+        if conn.execute("SELECT 1 FROM journal_meta WHERE name = 'rebuilt'").fetchone():
+            return
+        flush_logs()
+        rows = read_sheet_rows(SHEET_LOGS, "A:J")
+        entries = []      # (chat_id, kind, key, ts)
+        undone = set()    # (chat_id, kind, key)
+        for r in rows:
+            r = [str(x).strip() for x in r] + [""] * (10 - len(r))
+            r_chat, r_mid, r_status, r_err = r[1], r[5], r[7], r[8]
+            try:
+                ts = time.mktime(time.strptime(r[0], "%Y-%m-%d %H:%M:%S"))
+            except ValueError:
+                continue
+            if r_status == "OP_WRITE OK" and r_mid:
+                entries.append((r_chat, "op", r_mid, ts))
+            elif r_status in ("BULK_WRITE OK", "BULK_WRITE PARTIAL") and r_err:
+                entries.append((r_chat, "bulk", r_err, ts))
+            elif r_status in ("QUICK_WRITE OK", "QUICK_WRITE PARTIAL") and r_err:
+                entries.append((r_chat, "quick", r_err, ts))
+            elif r_status == "UNDO OK":
+                m = _undo_mid_re.search(r_err)
+                if m:
+                    undone.add((r_chat, "op", m.group(1)))
+                m = _undo_batch_re.search(r_err)
+                if m:
+                    undone.add((r_chat, "quick", m.group(1)))
+            elif r_status == "BULK_UNDO OK" and r_err:
+                undone.add((r_chat, "bulk", r_err))
+        conn.execute("BEGIN")
+        try:
+            for r_chat, kind, key, ts in entries:
+                if conn.execute(
+                    "SELECT 1 FROM journal WHERE chat_id = ? AND kind = ? AND key = ?", (r_chat, kind, key)
+                ).fetchone():
+                    continue
+                conn.execute(
+                    "INSERT INTO journal(chat_id, kind, key, ts, undone) VALUES (?, ?, ?, ?, ?)",
+                    (r_chat, kind, key, ts, 1 if (r_chat, kind, key) in undone else 0),
+                )
+            conn.execute("INSERT INTO journal_meta(name, value) VALUES ('rebuilt', ?)", (str(time.time()),))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        print("journal rebuilt from logs:", len(entries), "entries")
+
+def find_row_by_message_id_in_ops(target_message_id: str, sheet: str = SHEET_OPS):
     if not target_message_id:
         return None
-    col_m = read_column(SHEET_OPS, "M:M")  # MessageID column
+    if OPS_INDEX:
+        target = str(target_message_id).strip()
+        return _ops_index_find(
+            sheet,
+            lambda part: (part.by_mid.get(target) or [None])[-1],
+            lambda row: [f"{_a1(sheet)}!M{row}"] if row else [],
+            lambda row, got: not row or bool(got[0] and got[0][0] and str(got[0][0][0]).strip() == target),
+            None,
+        )
+    col_m = read_column(sheet, "M:M")  # MessageID column
     if not col_m:
         return None
     for idx in range(len(col_m) - 1, -1, -1):
@@ -337,11 +1772,19 @@ def find_row_by_message_id_in_ops(target_message_id: str):
             return idx + 1
     return None
 
-def find_rows_by_batch_id_in_ops(batch_id: str):
+def find_rows_by_batch_id_in_ops(batch_id: str, sheet: str = SHEET_OPS):
     # batch_id будет в колонке N (Комментарий)
     if not batch_id:
         return []
-    col_n = read_column(SHEET_OPS, "N:N")
+    if OPS_INDEX:
+        return _ops_index_find(
+            sheet,
+            lambda part: sorted(part.by_batch.get(batch_id, []), reverse=True),
+            lambda rows: [f"{_a1(sheet)}!N{min(rows)}:N{max(rows)}"] if rows else [],
+            lambda rows, got: not rows or _batch_rows_match(batch_id, rows, got[0]),
+            [],
+        )
+    col_n = read_column(sheet, "N:N")
     if not col_n:
         return []
     rows = []
@@ -350,6 +1793,146 @@ def find_rows_by_batch_id_in_ops(batch_id: str):
             rows.append(idx + 1)
     return rows
 
+def find_ops_rows(kind: str, key: str, sheet=None) -> list:
+    # строки записи из журнала -> [(лист, [номера строк]), ...]; "op" — по MessageID, "bulk"/"quick" — по batch_id.
+    # Без листа (старый журнал, пачка в несколько разделов) — по всем листам, свежие разделы первыми.
+    found = []
+    for sh in ([sheet] if sheet else ops_sheets()[::-1]):
+        if kind == "op":
+            rn = find_row_by_message_id_in_ops(key, sh)
+            if rn:
+                return [(sh, [rn])]
+        else:
+            rows = find_rows_by_batch_id_in_ops(key, sh)
+            if rows:
+                found.append((sh, rows))
+    return found
+
+def _batch_rows_match(batch_id: str, rows: list, values: list) -> bool:
+    lo = min(rows)
+    for rn in rows:
+        r = values[rn - lo] if rn - lo < len(values) else []
+        if batch_id not in str(r[0] if r else ""):
+            return False
+    return True
+
+# =========================
+# СПРАВОЧНИКИ: SNAPSHOT
+# =========================
+class RefData:
+    # неизменяемый снимок справочников; при обновлении подменяется целиком
+    __slots__ = (
+        "version", "objects", "types", "articles", "pay_types", "vat_values", "employees",
+        "objects_map", "types_map", "articles_map", "pay_types_map", "vat_map",
+        "kb_objects", "kb_types", "kb_articles", "kb_pay_types", "kb_vat",
+    )
+
+def _ref_key(s) -> str:
+    return re.sub(r"\s+", " ", str(s or "")).strip().casefold()
+
+def _kb_rows(values, per_row: int) -> list:
+    return [list(values[i:i + per_row]) for i in range(0, len(values), per_row)]
+
+def _make_ref(version: int, objects, articles, pay_types, vat_values, employees=()) -> RefData:
+    r = RefData()
+    r.version = version
+    r.objects = tuple(objects)
+    r.types = tuple(TYPES)
+    r.articles = tuple(articles)
+    r.pay_types = tuple(pay_types)
+    r.vat_values = tuple(vat_values)
+    r.employees = tuple(employees)   # пусто — справочник сотрудников строится из колонки J
+    # регистронезависимый поиск: нормализованный ключ -> каноническое написание
+    r.objects_map = MappingProxyType({_ref_key(x): x for x in r.objects})
+    r.types_map = MappingProxyType({_ref_key(x): x for x in r.types})
+    r.articles_map = MappingProxyType({_ref_key(x): x for x in r.articles})
+    r.pay_types_map = MappingProxyType({_ref_key(x): x for x in r.pay_types})
+    r.vat_map = MappingProxyType({_ref_key(x): x for x in r.vat_values})
+    # клавиатуры /new собираются один раз на версию справочников
+    r.kb_objects = kb(_kb_rows(r.objects, 3) + [["/cancel"]])
+    r.kb_types = kb(_kb_rows(r.types, 2) + [["/back", "/cancel"]])
+    r.kb_articles = kb(_kb_rows(r.articles, 2) + [["/back", "/cancel"]])
+    r.kb_pay_types = kb(_kb_rows(r.pay_types, 2) + [["/back", "/cancel"]])
+    r.kb_vat = kb([list(r.vat_values), ["/back", "/cancel"]])
+    return r
+
+_ref = None
+_ref_lock = threading.Lock()
+_ref_refresher = None
+
+def _load_ref_lists():
+    # (objects, articles, pay_types, vat_values, employees) из листа; пустая колонка — значения по умолчанию
+    found = {"objects": [], "articles": [], "pay_types": [], "vat_values": [], "employees": []}
+    for col in read_sheet_columns(REF_SHEET, "A:Z"):
+        if not col:
+            continue
+        head = _ref_key(col[0])
+        values = []
+        seen = set()
+        for v in col[1:]:
+            v = re.sub(r"\s+", " ", str(v or "")).strip()
+            if v and _ref_key(v) not in seen:
+                seen.add(_ref_key(v))
+                values.append(v)
+        if "объект" in head:
+            found["objects"] = values
+        elif "стат" in head:
+            found["articles"] = values
+        elif "способ" in head or "оплат" in head:
+            found["pay_types"] = values
+        elif "ндс" in head:
+            found["vat_values"] = [v.upper() for v in values]
+        elif "сотрудн" in head:
+            found["employees"] = values
+    return (
+        tuple(found["objects"] or OBJECTS),
+        tuple(found["articles"] or ARTICLES),
+        tuple(found["pay_types"] or PAY_TYPES),
+        tuple(found["vat_values"] or VAT_VALUES),
+        tuple(found["employees"]),
+    )
+
+def _refresh_ref():
+    global _ref
+    lists = _load_ref_lists()
+    with _ref_lock:
+        cur = _ref
+        if cur and lists == (cur.objects, cur.articles, cur.pay_types, cur.vat_values, cur.employees):
+            return
+        _ref = _make_ref((cur.version + 1) if cur else 1, *lists)
+    print("reference data updated, version", _ref.version)
+
+def _ref_refresher_loop():
+    _sheets_ctx.prio = PRIO_BACKGROUND
+    while True:
+        time.sleep(REF_TTL_SECONDS)
+        try:
+            _refresh_ref()
+        except Exception as e:
+            print("reference refresh error:", repr(e))
+
+def ref() -> RefData:
+    # текущий снимок; первый вызов читает лист синхронно и запускает фоновое обновление
+    global _ref, _ref_refresher
+    if _ref is not None:
+        return _ref
+    with _ref_lock:
+        if _ref is None and not REF_SHEET:
+            _ref = _make_ref(1, OBJECTS, ARTICLES, PAY_TYPES, VAT_VALUES)
+    if _ref is None:
+        try:
+            _refresh_ref()
+        except Exception as e:
+            print("reference load error, using defaults:", repr(e))
+            with _ref_lock:
+                if _ref is None:
+                    _ref = _make_ref(1, OBJECTS, ARTICLES, PAY_TYPES, VAT_VALUES)
+        with _ref_lock:
+            if _ref_refresher is None:
+                _ref_refresher = threading.Thread(target=_ref_refresher_loop, name="ref-refresher", daemon=True)
+                _ref_refresher.start()
+    return _ref
+
 # =========================
 # VALIDATION (быстрый ввод через ;)
 # =========================
@@ -363,15 +1946,18 @@ def validate_and_parse(text: str):
         )
 
     object_, type_, article, amount_raw, pay_type, vat, period_raw, employee, comment = parts
+    r = ref()
 
-    if object_ not in OBJECTS:
+    object_ = r.objects_map.get(_ref_key(object_))
+    if not object_:
         return None, "❌ Объект только из списка. Используй /new (кнопки) или напиши как в справочнике."
 
-    type_up = type_.upper()
-    if type_up not in TYPES:
-        return None, "❌ Тип только: РАСХОД / ЗП / АВАНС / ДОХОД"
+    type_up = r.types_map.get(_ref_key(type_))
+    if not type_up:
+        return None, "❌ Тип только: " + " / ".join(r.types)
 
-    if article not in ARTICLES:
+    article = r.articles_map.get(_ref_key(article))
+    if not article:
         return None, "❌ Статья только из списка. Используй /new (кнопки) или напиши как в справочнике."
 
     try:
@@ -382,12 +1968,13 @@ def validate_and_parse(text: str):
     except:
         return None, "❌ Сумма должна быть числом"
 
-    if pay_type not in PAY_TYPES:
-        return None, "❌ Способ оплаты только: НАЛ / БЕЗНАЛ / ЗП_ОФИЦ / АВАНС / ПРЕДОПЛАТА"
+    pay_type = r.pay_types_map.get(_ref_key(pay_type))
+    if not pay_type:
+        return None, "❌ Способ оплаты только: " + " / ".join(r.pay_types)
 
-    vat_up = vat.upper()
-    if vat_up not in VAT_VALUES:
-        return None, "❌ НДС только ДА или НЕТ"
+    vat_up = r.vat_map.get(_ref_key(vat))
+    if not vat_up:
+        return None, "❌ НДС только " + " или ".join(r.vat_values)
 
     period_raw = period_raw.strip()
     if not re.match(r"^\d{4}-\d{2}-[12]$", period_raw):
@@ -412,57 +1999,27 @@ def validate_and_parse(text: str):
 # /new FLOW
 # =========================
 def _newflow_get(chat_id: int):
-    st = _new_flow.get(chat_id)
-    if not st:
-        return None
-    if time.time() - st.get("ts", 0) > NEW_FLOW_TTL:
-        _new_flow.pop(chat_id, None)
-        return None
-    return st
+    return state_store().get("new", str(chat_id))
 
 def _newflow_set(chat_id: int, step: int, data: dict):
-    _new_flow[chat_id] = {"step": step, "data": data, "ts": time.time()}
+    state_store().set("new", str(chat_id), {"step": step, "data": data, "ts": time.time()}, NEW_FLOW_TTL)
 
 def _newflow_clear(chat_id: int):
-    _new_flow.pop(chat_id, None)
+    state_store().delete("new", str(chat_id))
 
 def _ask_step(chat_id: int, step: int):
     if step == 1:
-        send_message(chat_id, "Шаг 1/9: Выбери объект:", kb([
-            ["ОКТЯБРЬСКИЙ", "ОБУХОВО", "ОДИНЦОВО"],
-            ["ЭКИПАЖ", "24 СКЛАД", "ЯРЦЕВО"],
-            ["ОБЩЕХОЗ"],
-            ["/cancel"]
-        ]))
+        send_message(chat_id, "Шаг 1/9: Выбери объект:", ref().kb_objects)
     elif step == 2:
-        send_message(chat_id, "Шаг 2/9: Выбери тип:", kb([
-            ["РАСХОД", "ЗП"],
-            ["АВАНС", "ДОХОД"],
-            ["/back", "/cancel"]
-        ]))
+        send_message(chat_id, "Шаг 2/9: Выбери тип:", ref().kb_types)
     elif step == 3:
-        rows = []
-        row = []
-        for a in ARTICLES:
-            row.append(a)
-            if len(row) == 2:
-                rows.append(row)
-                row = []
-        if row:
-            rows.append(row)
-        rows.append(["/back", "/cancel"])
-        send_message(chat_id, "Шаг 3/9: Выбери статью:", kb(rows))
+        send_message(chat_id, "Шаг 3/9: Выбери статью:", ref().kb_articles)
     elif step == 4:
         send_message(chat_id, "Шаг 4/9: Введи сумму (пример: 1000 или 10 000 или 1000,50):", kb([["/back", "/cancel"]]))
     elif step == 5:
-        send_message(chat_id, "Шаг 5/9: Выбери способ оплаты:", kb([
-            ["НАЛ", "БЕЗНАЛ"],
-            ["ЗП_ОФИЦ", "АВАНС"],
-            ["ПРЕДОПЛАТА"],
-            ["/back", "/cancel"]
-        ]))
+        send_message(chat_id, "Шаг 5/9: Выбери способ оплаты:", ref().kb_pay_types)
     elif step == 6:
-        send_message(chat_id, "Шаг 6/9: НДС?", kb([["ДА", "НЕТ"], ["/back", "/cancel"]]))
+        send_message(chat_id, "Шаг 6/9: НДС?", ref().kb_vat)
     elif step == 7:
         send_message(
             chat_id,
@@ -478,21 +2035,16 @@ def _ask_step(chat_id: int, step: int):
 # /bulk FLOW
 # =========================
 def _bulk_get(chat_id: int):
-    st = _bulk_flow.get(chat_id)
-    if not st:
-        return None
-    if time.time() - st.get("ts", 0) > BULK_FLOW_TTL:
-        _bulk_flow.pop(chat_id, None)
-        return None
-    return st
+    return state_store().get("bulk", str(chat_id))
 
 def _bulk_set(chat_id: int, step: int, hdr: dict, items: list):
-    _bulk_flow[chat_id] = {"step": step, "hdr": hdr, "items": items, "ts": time.time()}
+    state_store().set("bulk", str(chat_id), {"step": step, "hdr": hdr, "items": items, "ts": time.time()}, BULK_FLOW_TTL)
 
 def _bulk_clear(chat_id: int):
-    _bulk_flow.pop(chat_id, None)
+    state_store().delete("bulk", str(chat_id))
 
 _amount_end_re = re.compile(r"(\d[\d\s]*([.,]\d+)?)(\s*[кk])?\s*$", re.IGNORECASE)
+_numbering_re = re.compile(r"^\s*\d+\s*[\)\.\-]\s*")
 
 def _parse_amount_and_name(line: str):
     s = (line or "").strip()
@@ -500,7 +2052,7 @@ def _parse_amount_and_name(line: str):
         return None, None
 
     # убираем нумерацию в начале: "1) ..." / "1. ..." / "1 - ..."
-    s = re.sub(r"^\s*\d+\s*[\)\.\-]\s*", "", s)
+    s = _numbering_re.sub("", s)
 
     # заменяем " = " на пробел
     s = s.replace("=", " ").replace("—", "-")
@@ -526,12 +2078,163 @@ def _parse_amount_and_name(line: str):
         return None, None
     return val, name
 
+def _parse_bulk_lines(text: str):
+    # вставка из нескольких строк за один проход -> (items, rejected[(номер строки, текст)])
+    items = []
+    rejected = []
+    for n, line in enumerate((text or "").splitlines(), start=1):
+        if not line.strip():
+            continue
+        val, name = _parse_amount_and_name(line)
+        if not name or val is None:
+            rejected.append((n, line.strip()))
+            continue
+        items.append({"name": name, "amount": float(val)})
+    return items, rejected
+
+def new_batch_id(prefix: str) -> str:
+    # суффикс — чтобы пачки разных чатов в одну секунду не склеивались при /undo_bulk
+    return f"{prefix}-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(2)}"
+
+def _bulk_parsed(hdr: dict, item: dict, batch_id: str) -> dict:
+    return {
+        "object": hdr["object"],
+        "type": "АВАНС",
+        "article": hdr["article"],
+        "amount": item["amount"],
+        "pay_type": hdr["pay_type"],
+        "vat": hdr["vat"],
+        "period": hdr["period"],
+        "employee": item["name"],
+        "comment": f'{hdr.get("comment","").strip()} [{batch_id}]'.strip(),
+    }
+
+# =========================
+# /bulk FILES (CSV / XLSX)
+# =========================
+# Файл в шаге 2 /bulk = готовая пачка: строки читаются потоком, валидные пишутся
+# чанками по SHEETS_APPEND_CHUNK, в памяти держим только текущий чанк и первые ошибки.
+BULK_FILE_MAX_BYTES = 20 * 1024 * 1024   # больше Bot API всё равно не отдаёт
+BULK_FILE_MAX_ROWS = int(os.environ.get("BULK_FILE_MAX_ROWS", "10000"))
+BULK_FILE_ERRORS_SHOWN = 15
+_spool_max = 2 * 1024 * 1024             # xlsx до 2 МБ держим в памяти, больше — во временном файле
+
+def _tg_file_stream(file_id: str):
+    info = telegram_client().call("getFile", json.dumps({"file_id": file_id}))
+    if not info or not info.get("file_path"):
+        raise RuntimeError("Telegram не отдал файл (getFile)")
+    r = telegram_client().session.get(f"{TG_FILE_API}/{info['file_path']}", stream=True, timeout=60)
+    r.raise_for_status()
+    return r
+
+def _iter_csv_rows(resp):
+    # построчно из HTTP-потока; кодировка utf-8 (c BOM) или cp1251 (выгрузка из Excel)
+    state = {"enc": "utf-8-sig"}
+
+    def lines():
+        for raw in resp.iter_lines():
+            try:
+                yield raw.decode(state["enc"])
+            except UnicodeDecodeError:
+                state["enc"] = "cp1251"
+                yield raw.decode("cp1251", errors="replace")
+
+    it = lines()
+    first = next(it, None)
+    if first is None:
+        return
+    delim = max(";,\t", key=first.count) if any(c in first for c in ";,\t") else ";"
+    yield from csv.reader(itertools.chain([first], it), delimiter=delim)
+
+def _iter_xlsx_rows(resp):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise RuntimeError("XLSX на сервере не поддерживается (нет openpyxl) — пришли CSV")
+    with tempfile.SpooledTemporaryFile(max_size=_spool_max) as f:
+        for chunk in resp.iter_content(64 * 1024):
+            f.write(chunk)
+        f.seek(0)
+        wb = load_workbook(f, read_only=True, data_only=True)
+        try:
+            for row in wb.worksheets[0].iter_rows(values_only=True):
+                yield ["" if v is None else str(v) for v in row]
+        finally:
+            wb.close()
+
+def _bulk_cells_to_line(cells: list) -> str:
+    cells = [str(c).strip() for c in cells if str(c or "").strip()]
+    # первая колонка — номер по порядку (1, 2, 3...), если есть ещё хотя бы имя и сумма
+    if len(cells) >= 3 and re.fullmatch(r"\d+[.)]?", cells[0]):
+        cells = cells[1:]
+    return " ".join(cells)
+
+def _bulk_write_file(hdr: dict, items: list, document: dict, message_id):
+    # -> (batch_id, written, ranges, errors_total, errors_shown, err, fixed, hints)
+    name = (document.get("file_name") or "").lower()
+    if int(document.get("file_size") or 0) > BULK_FILE_MAX_BYTES:
+        raise RuntimeError("файл больше 20 МБ")
+    if name.endswith(".xlsx"):
+        reader = _iter_xlsx_rows
+    elif name.endswith((".csv", ".txt")):
+        reader = _iter_csv_rows
+    else:
+        raise RuntimeError("нужен файл .csv или .xlsx")
+
+    batch_id = new_batch_id("BULK")
+    chunk = [_bulk_parsed(hdr, it, batch_id) for it in items]
+    ranges = []
+    written = 0
+    errors_total = 0
+    errors_shown = []
+    err = None
+    fixed, hints = {}, {}   # было -> стало / как ввели -> подсказка, без повторов
+
+    resp = _tg_file_stream(document["file_id"])
+    try:
+        for n, cells in enumerate(reader(resp), start=1):
+            if n > BULK_FILE_MAX_ROWS:
+                errors_total += 1
+                errors_shown.append(f"строки после {BULK_FILE_MAX_ROWS} не читал")
+                break
+            line = _bulk_cells_to_line(cells)
+            if not line:
+                continue
+            val, emp = _parse_amount_and_name(line)
+            if not emp or val is None:
+                if n == 1:
+                    continue   # шапка таблицы ("ФИО; Сумма")
+                errors_total += 1
+                if len(errors_shown) < BULK_FILE_ERRORS_SHOWN:
+                    errors_shown.append(f"{n}: {line[:60]}")
+                continue
+            name, hint = canon_employee(emp)
+            if hint:
+                hints[emp] = hint
+            elif name != emp:
+                fixed[emp] = name
+            chunk.append(_bulk_parsed(hdr, {"name": name, "amount": float(val)}, batch_id))
+            if len(chunk) >= SHEETS_APPEND_CHUNK:
+                got, err = _write_operations(chunk, message_id)
+                ranges += got
+                if err:
+                    break
+                written += len(chunk)
+                chunk = []
+        if chunk and not err:
+            got, err = _write_operations(chunk, message_id)
+            ranges += got
+            if not err:
+                written += len(chunk)
+    finally:
+        resp.close()
+    return batch_id, written, ranges, errors_total, errors_shown, err, list(fixed.items()), list(hints.items())
+
 # =========================
 # WRITE OP
 # =========================
-def _write_operation(parsed: dict, message_id):
-    now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    row = [
+def _op_row(parsed: dict, message_id, now_str: str):
+    return [
         now_str,                 # A DateTime
         parsed["object"],        # B Объект
         parsed["type"],          # C Тип
@@ -547,7 +2250,797 @@ def _write_operation(parsed: dict, message_id):
         str(message_id or ""),   # M MessageID
         parsed.get("comment", ""),  # N Комментарий
     ]
-    append_row(SHEET_OPS, row)
+
+def _write_operation(parsed: dict, message_id, chat_id):
+    # updatedRange строки; "" — строка пока в outbox и номера ещё нет
+    now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    row = _op_row(parsed, message_id, now_str)
+    if OUTBOX_DB:
+        outbox_put([row], chat_id)
+        return ""
+    return _ops_append(ensure_ops_sheet(ops_sheet_for(parsed["period"])), [row])
+
+def _write_operations(parsed_list: list, message_id):
+    # пачка операций одним append (с авто-чанками).
+    # Возвращает (ranges, err): ranges — updatedRange уже записанных чанков,
+    # err — исключение, если какой-то чанк не записался (предыдущие при этом уже в таблице).
+    # С OPS_PARTITION строки разных периодов уходят каждая в свой раздел.
+    now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    by_sheet = {}
+    for p in parsed_list:
+        by_sheet.setdefault(ops_sheet_for(p["period"]), []).append(_op_row(p, message_id, now_str))
+    ranges = []
+    for sheet, rows in by_sheet.items():
+        for i in range(0, len(rows), SHEETS_APPEND_CHUNK):
+            try:
+                ranges.append(_ops_append(ensure_ops_sheet(sheet), rows[i:i + SHEETS_APPEND_CHUNK]))
+            except Exception as e:
+                return ranges, e
+    return ranges, None
+
+def _ranges_text(ranges: list) -> str:
+    spans = [range_rows(r) for r in ranges]
+    return ", ".join(f"{a}–{b}" if a != b else str(a) for a, b in (sp for sp in spans if sp))
+
+# =========================
+# GROUP COMMIT (ОПЕРАЦИИ)
+# =========================
+# Записи из разных чатов, пришедшие в одно окно OPS_COMMIT_WINDOW_MS, уходят одним append;
+# каждый вызывающий получает через Future свой кусок updatedRange.
+_ops_commit_pending = []  # [(лист, rows, Future)]
+_ops_commit_cond = threading.Condition()
+_ops_committer = None
+
+def _ops_append(sheet: str, rows: list) -> str:
+    # rows не длиннее SHEETS_APPEND_CHUNK; возвращает updatedRange именно этих строк
+    if OPS_COMMIT_WINDOW_MS <= 0 or len(rows) >= SHEETS_APPEND_CHUNK:
+        return append_rows(sheet, rows)[0]
+    fut = Future()
+    _start_ops_committer()
+    with _ops_commit_cond:
+        _ops_commit_pending.append((sheet, rows, fut))
+        _ops_commit_cond.notify()
+    return fut.result()
+
+def _start_ops_committer():
+    global _ops_committer
+    if _ops_committer is not None:
+        return
+    with _ops_commit_cond:
+        if _ops_committer is not None:
+            return
+        _ops_committer = threading.Thread(target=_ops_committer_loop, name="ops-committer", daemon=True)
+        _ops_committer.start()
+
+def _ops_committer_loop():
+    while True:
+        with _ops_commit_cond:
+            while not _ops_commit_pending:
+                _ops_commit_cond.wait()
+        # первый пришёл — ждём окно, чтобы подтянулись остальные
+        time.sleep(OPS_COMMIT_WINDOW_MS / 1000.0)
+        with _ops_commit_cond:
+            batch = _ops_commit_pending[:]
+            _ops_commit_pending.clear()
+        try:
+            _ops_commit_flush(batch)
+        except Exception as e:
+            print("ops committer error:", repr(e))
+
+def _ops_commit_flush(batch: list):
+    # пакуем заявки каждого листа в группы не больше SHEETS_APPEND_CHUNK строк, одна группа = один append
+    groups = []   # [(лист, [(rows, fut), ...])]
+    open_groups = {}   # лист -> [группа, строк в ней]
+    for sheet, rows, fut in batch:
+        cur = open_groups.get(sheet)
+        if cur is None or (cur[1] + len(rows) > SHEETS_APPEND_CHUNK and cur[0]):
+            cur = open_groups[sheet] = [[], 0]
+            groups.append((sheet, cur[0]))
+        cur[0].append((rows, fut))
+        cur[1] += len(rows)
+
+    for sheet, group in groups:
+        try:
+            updated = append_rows(sheet, [r for rows, _ in group for r in rows])[0]
+        except Exception as e:
+            for _, fut in group:
+                fut.set_exception(e)
+            continue
+        offset = 0
+        for rows, fut in group:
+            fut.set_result(_sub_range(updated, offset, len(rows)))
+            offset += len(rows)
+
+_a1_range_re = re.compile(r"^([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?$")
+
+def _sub_range(updated_range: str, offset: int, n: int) -> str:
+    # "'ОПЕРАЦИИ'!A10:N14", offset=2, n=2 -> "'ОПЕРАЦИИ'!A12:N13"
+    prefix, _, a1 = (updated_range or "").rpartition("!")
+    m = _a1_range_re.match(a1)
+    if not prefix or not m:
+        return ""
+    c1, first, c2 = m.group(1), int(m.group(2)), m.group(3) or m.group(1)
+    return f"{prefix}!{c1}{first + offset}:{c2}{first + offset + n - 1}"
+
+# =========================
+# OUTBOX (ОПЕРАЦИИ)
+# =========================
+def _outbox():
+    global _outbox_db
+    with _outbox_lock:
+        if _outbox_db is None:
+            conn = sqlite3.connect(OUTBOX_DB, timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    mid TEXT NOT NULL,
+                    row TEXT NOT NULL,               -- JSON значений A..N
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    ts REAL NOT NULL,
+                    chat_id TEXT NOT NULL DEFAULT '' -- message_id уникален только внутри чата
+                );
+            """)
+            if "chat_id" not in {c[1] for c in conn.execute("PRAGMA table_info(outbox)")}:
+                conn.execute("ALTER TABLE outbox ADD COLUMN chat_id TEXT NOT NULL DEFAULT ''")   # outbox от старой версии
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_chat_mid ON outbox(chat_id, mid)")
+            _outbox_db = conn
+        return _outbox_db
+
+def _outbox_tag() -> str:
+    # метка строки outbox в Комментарии (N), разбирается как batch-тег: по ней перенос
+    # узнаёт уже дошедшую строку (MessageID уникален только внутри чата)
+    return f"OB-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(6)}"
+
+def outbox_put(rows: list, chat_id):
+    # возвращается, когда строки уже на диске; каждой строке (одиночной операции) — своя метка OB-
+    now_ts = time.time()
+    for r in rows:
+        r[13] = f"{r[13]} [{_outbox_tag()}]".strip()
+    with _outbox_lock:
+        conn = _outbox()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT INTO outbox(chat_id, mid, row, ts) VALUES (?, ?, ?, ?)",
+                [(str(chat_id), str(r[12]), json.dumps(r, ensure_ascii=False), now_ts) for r in rows],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    _start_outbox_flusher()
+    _outbox_wakeup.set()
+
+def outbox_pending() -> int:
+    if not OUTBOX_DB:
+        return 0
+    with _outbox_lock:
+        return _outbox().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+def outbox_cancel(chat_id, message_id) -> int:
+    # /undo операции, которая ещё не ушла в Sheets: убираем из outbox; сколько строк убрали.
+    # Ждём текущий перенос — иначе строка может оказаться в таблице уже после проверки.
+    if not OUTBOX_DB:
+        return 0
+    with _outbox_flush_lock:
+        with _outbox_lock:
+            return _outbox().execute(
+                "DELETE FROM outbox WHERE chat_id = ? AND mid = ?", (str(chat_id), str(message_id))
+            ).rowcount
+
+def _ops_tags_present(sheet: str, tags: set) -> set:
+    # какие метки outbox (batch-теги OB-...) уже есть на листе ОПЕРАЦИИ
+    if OPS_INDEX:
+        part = _ops_part_ready(sheet)
+        with _ops_index_lock:
+            return {t for t in tags if part.by_batch.get(t)}
+    have = {_ops_key("", v)[1] for v in read_column(sheet, "N:N")}
+    return tags & have
+
+def outbox_flush() -> int:
+    # переносит всё накопленное в ОПЕРАЦИИ; возвращает число записанных строк.
+    # При ошибке исключение летит дальше, а строки остаются в outbox до следующего раза.
+    written = 0
+    with _outbox_flush_lock:
+        while True:
+            with _outbox_lock:
+                batch = _outbox().execute(
+                    "SELECT id, row, attempts FROM outbox ORDER BY id LIMIT ?", (SHEETS_APPEND_CHUNK,)
+                ).fetchall()
+            if not batch:
+                return written
+            entries = [(oid, json.loads(raw), attempts) for oid, raw, attempts in batch]
+
+            # строки, которые уже пытались отправить, могли дойти (обрыв после append, рестарт) —
+            # такие ищем на их листе по метке OB-, чтобы не задвоить
+            suspect = {}
+            for _, v, attempts in entries:
+                tag = _ops_key("", v[13])[1]
+                if attempts and tag:
+                    suspect.setdefault(ops_sheet_for(v[8]), set()).add(tag)
+            present = set()
+            for sheet, tags in suspect.items():
+                if sheet in _sheet_id_cache or sheet == SHEET_OPS:
+                    present |= _ops_tags_present(sheet, tags)
+            todo = [(oid, v) for oid, v, _ in entries if _ops_key("", v[13])[1] not in present]
+
+            ids = [(oid,) for oid, _, _ in entries]
+            if todo:
+                with _outbox_lock:
+                    _outbox().executemany("UPDATE outbox SET attempts = attempts + 1 WHERE id = ?",
+                                          [(oid,) for oid, _ in todo])
+                by_sheet = {}
+                for _, v in todo:
+                    by_sheet.setdefault(ops_sheet_for(v[8]), []).append(v)
+                try:
+                    for sheet, rows in by_sheet.items():
+                        append_rows(ensure_ops_sheet(sheet), rows)
+                except Exception:
+                    if OPS_INDEX:
+                        for sheet in by_sheet:   # append мог пройти без ответа — листы перечитаем
+                            _ops_index_invalidate(sheet)
+                    raise
+            with _outbox_lock:
+                _outbox().executemany("DELETE FROM outbox WHERE id = ?", ids)
+            written += len(todo)
+
+def _start_outbox_flusher():
+    global _outbox_flusher
+    if _outbox_flusher is not None:
+        return
+    with _outbox_lock:
+        if _outbox_flusher is not None:
+            return
+        _outbox_flusher = threading.Thread(target=_outbox_flusher_loop, name="outbox-flusher", daemon=True)
+        _outbox_flusher.start()
+
+def _outbox_flusher_loop():
+    delay = OUTBOX_FLUSH_INTERVAL
+    while True:
+        _outbox_wakeup.wait(delay)
+        _outbox_wakeup.clear()
+        try:
+            outbox_flush()
+            delay = OUTBOX_FLUSH_INTERVAL
+        except Exception as e:
+            # Sheets лежит — не долбим его каждую секунду (и не перечитываем зеркало)
+            delay = min(60.0, max(delay, 0.5) * 2)
+            print("outbox flush error:", repr(e), "pending:", outbox_pending(), f"retry in {delay:.0f}s")
+
+def outbox_resume():
+    # после рестарта: если в outbox что-то осталось — запускаем перенос
+    if OUTBOX_DB and outbox_pending():
+        print("outbox: pending rows after restart:", outbox_pending())
+        _start_outbox_flusher()
+        _outbox_wakeup.set()
+
+# =========================
+# UPDATE QUEUE (ack-first)
+# =========================
+# Очередь шардирована по chat_id: у каждого воркера своя очередь, поэтому шаги
+# /new и /bulk одного чата обрабатываются строго по порядку, а разные чаты — параллельно.
+_update_queues = []      # list[queue.Queue], по одной на воркера
+_update_workers = []     # list[threading.Thread]
+_update_queue_lock = threading.Lock()
+_update_queue_closed = False
+
+def _update_chat_id(data: dict) -> int:
+    msg = data.get("message") or data.get("edited_message") or {}
+    try:
+        return int((msg.get("chat") or {}).get("id") or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def _update_worker(q: queue.Queue):
+    while True:
+        data = q.get()
+        try:
+            if data is None:
+                return
+            process_update(data)
+        except Exception as e:
+            print("update worker error:", repr(e))
+        finally:
+            q.task_done()
+
+def _start_update_workers():
+    # запускаем лениво, уже в процессе-воркере gunicorn (после fork). Проверка без блокировки
+    # безопасна: списки собираем локально и публикуем целиком, наполовину заполненных не видно
+    global _update_queues, _update_workers
+    if _update_queues:
+        return
+    with _update_queue_lock:
+        if _update_queues:
+            return
+        queues, workers = [], []
+        for i in range(WEBHOOK_WORKERS):
+            q = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+            t = threading.Thread(target=_update_worker, args=(q,), name=f"update-worker-{i}", daemon=True)
+            t.start()
+            queues.append(q)
+            workers.append(t)
+        _update_workers = workers
+        _update_queues = queues
+
+def _update_queue_for(data: dict) -> queue.Queue:
+    return _update_queues[abs(_update_chat_id(data)) % len(_update_queues)]
+
+def enqueue_update(data: dict) -> bool:
+    # False = очередь переполнена (backpressure) или идёт остановка
+    if _update_queue_closed:
+        return False
+    _start_update_workers()
+    q = _update_queue_for(data)
+    try:
+        q.put(data, timeout=WEBHOOK_ENQUEUE_TIMEOUT)
+        return True
+    except queue.Full:
+        return False
+
+def _drain_update_queues():
+    # graceful shutdown: дорабатываем то, что уже в очередях, но не дольше WEBHOOK_DRAIN_TIMEOUT
+    global _update_queue_closed
+    if _update_queue_closed:
+        return
+    _update_queue_closed = True
+    deadline = time.time() + WEBHOOK_DRAIN_TIMEOUT
+    for q in _update_queues:
+        try:
+            q.put(None, timeout=max(0.0, deadline - time.time()))
+        except queue.Full:
+            pass
+    for t in _update_workers:
+        t.join(timeout=max(0.0, deadline - time.time()))
+    left = sum(q.qsize() for q in _update_queues)
+    if left:
+        print("update queue drain: unprocessed updates left:", left)
+
+# =========================
+# REPORT (агрегаты по ОПЕРАЦИИ)
+# =========================
+# (объект, тип, статья, период, способ) -> [сумма, кол-во]; строится из зеркала ОПЕРАЦИИ
+# и поддерживается инкрементально: запись/удаление строк приходят через _ops_hooks.
+_report_agg = {}
+_report_lock = threading.Lock()
+
+def _report_hook(event: str, rows: list):
+    with _report_lock:
+        sign = -1 if event == "delete" else 1
+        for r in rows:
+            if r.amount is None or not r.object:
+                continue
+            key = (r.object, r.type, r.article, r.period, r.pay_type)
+            agg = _report_agg.get(key)
+            if agg is None:
+                agg = _report_agg[key] = [0.0, 0]
+            agg[0] += sign * r.amount
+            agg[1] += sign
+            if agg[1] <= 0:
+                del _report_agg[key]
+
+_ops_hooks.append(_report_hook)
+
+def _period_match(period: str, query: str) -> bool:
+    # query: YYYY-MM-1 / YYYY-MM-2 (половина месяца), YYYY-MM (месяц), YYYY (год), * (всё)
+    if query == "*":
+        return True
+    return period == query or period.startswith(query + "-")
+
+def _fmt_amount(v: float) -> str:
+    s = f"{v:,.2f}".rstrip("0").rstrip(".")
+    return s.replace(",", " ")
+
+def build_report(object_query: str, period_query: str) -> str:
+    ops_mirror()
+    obj_key = _ref_key(object_query)
+    by_type = {}
+    by_article = {}
+    by_pay = {}
+    objects = set()
+    with _report_lock:
+        for (obj, type_, article, period, pay_type), (total, cnt) in _report_agg.items():
+            if obj_key != "*" and _ref_key(obj) != obj_key:
+                continue
+            if not _period_match(period, period_query):
+                continue
+            objects.add(obj)
+            t = by_type.setdefault(type_, [0.0, 0])
+            t[0] += total
+            t[1] += cnt
+            by_article[article] = by_article.get(article, 0.0) + total
+            by_pay[pay_type] = by_pay.get(pay_type, 0.0) + total
+
+    title = "все объекты" if obj_key == "*" else (", ".join(sorted(objects)) or object_query)
+    if not by_type:
+        return f"📊 {title}, {period_query}: операций нет."
+
+    lines = [f"📊 {title}, {period_query}"]
+    for type_, (total, cnt) in sorted(by_type.items(), key=lambda x: -x[1][0]):
+        lines.append(f"{type_}: {_fmt_amount(total)} ({cnt} оп.)")
+    lines.append("")
+    lines.append("По статьям:")
+    top = sorted(by_article.items(), key=lambda x: -x[1])
+    for article, total in top[:REPORT_TOP]:
+        lines.append(f"  {article} — {_fmt_amount(total)}")
+    if len(top) > REPORT_TOP:
+        lines.append(f"  … ещё {len(top) - REPORT_TOP}")
+    lines.append("По способам оплаты:")
+    for pay_type, total in sorted(by_pay.items(), key=lambda x: -x[1]):
+        lines.append(f"  {pay_type} — {_fmt_amount(total)}")
+    return "\n".join(lines)
+
+REPORT_TOP = 15
+_report_cmd_re = re.compile(r"^/report(?:@\w+)?(?:\s+(.+?))?\s*$", re.IGNORECASE)
+_report_period_re = re.compile(r"^(\*|\d{4}(?:-\d{2}(?:-[12])?)?)$")
+
+_undo_cmd_re = re.compile(r"^/undo(?:\s+(\d+))?$")
+
+# =========================
+# FIND (/find ТЕКСТ [ПЕРИОД])
+# =========================
+# Триграммный индекс по Сотрудник (J) + Комментарий (N) строк зеркала. Тексты сильно повторяются
+# (одни и те же сотрудники), поэтому индексируются различные тексты: триграмма -> {текст},
+# текст -> {uid}. Наполняется при загрузке листов зеркала и дальше обновляется через _ops_hooks
+# (запись, /undo, /undo_bulk, перечит листа). Кандидаты — пересечение списков триграмм, затем проверка подстрокой.
+FIND_LIMIT = 20
+_find_docs = {}          # uid -> (нормализованный текст, OpRow)
+_find_texts = {}         # текст -> set(uid)
+_find_grams = {}         # триграмма -> set(текст)
+_find_lock = threading.Lock()
+_find_cmd_re = re.compile(r"^/find(?:@\w+)?(?:\s+(.+?))?\s*$", re.IGNORECASE)
+
+def _find_norm(s: str) -> str:
+    return _ref_key(s).replace("ё", "е")
+
+def _trigrams(s: str) -> set:
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+def _find_hook(event: str, rows: list):
+    with _find_lock:
+        if event == "delete":
+            for r in rows:
+                doc = _find_docs.pop(r.uid, None)
+                if doc is None:
+                    continue
+                uids = _find_texts.get(doc[0])
+                uids.discard(r.uid)
+                if uids:
+                    continue
+                del _find_texts[doc[0]]
+                for g in _trigrams(doc[0]):
+                    posting = _find_grams.get(g)
+                    if posting is not None:
+                        posting.discard(doc[0])
+                        if not posting:
+                            del _find_grams[g]
+            return
+        norm = {}            # (сотрудник, коммент) -> текст: в пачке одно и то же встречается часто
+        for r in rows:
+            if r.amount is None:
+                continue   # пустые строки и заголовки листов
+            raw = (r.employee, r.comment)
+            text = norm.get(raw)
+            if text is None:
+                text = norm[raw] = _find_norm(f"{r.employee} {_batch_tag_re.sub('', r.comment)}")
+            if not text:
+                continue
+            _find_docs[r.uid] = (text, r)
+            uids = _find_texts.get(text)
+            if uids is None:
+                uids = _find_texts[text] = set()
+                for g in _trigrams(text):
+                    posting = _find_grams.get(g)
+                    if posting is None:
+                        posting = _find_grams[g] = set()
+                    posting.add(text)
+            uids.add(r.uid)
+
+_ops_hooks.append(_find_hook)
+
+def find_operations(query: str, period_query: str = "*"):
+    # -> (строки по убыванию даты, сумма по всем совпадениям)
+    ops_mirror()
+    q = _find_norm(query)
+    with _find_lock:
+        grams = _trigrams(q)
+        if grams:
+            postings = sorted((_find_grams.get(g, ()) for g in grams), key=len)
+            cands = set(postings[0]).intersection(*postings[1:]) if postings[0] else set()
+        else:
+            cands = _find_texts.keys()   # запрос короче 3 символов — перебор различных текстов
+        hits = [_find_docs[uid][1] for text in cands if q in text for uid in _find_texts[text]]
+    hits = [r for r in hits if _period_match(r.period, period_query)]
+    hits.sort(key=lambda r: (r.dt, r.uid), reverse=True)
+    return hits, sum(r.amount or 0.0 for r in hits)
+
+def build_find_reply(query: str, period_query: str = "*") -> str:
+    hits, total = find_operations(query, period_query)
+    where = "" if period_query == "*" else f", {period_query}"
+    if not hits:
+        return f"🔎 «{query}»{where}: ничего не нашёл."
+    lines = [f"🔎 «{query}»{where}: {len(hits)} оп. на {_fmt_amount(total)}"]
+    for r in hits[:FIND_LIMIT]:
+        comment = _batch_tag_re.sub("", r.comment).strip()
+        lines.append(f"{r.period} · {r.object} · {r.article} · {r.employee} — "
+                     f"{_fmt_amount(r.amount or 0.0)}" + (f" ({comment})" if comment and comment != "-" else ""))
+    if len(hits) > FIND_LIMIT:
+        lines.append(f"… ещё {len(hits) - FIND_LIMIT}")
+    return "\n".join(lines)
+
+# =========================
+# СОТРУДНИКИ (нечёткое сопоставление ФИО)
+# =========================
+# Справочник сотрудников — колонка СОТРУДНИК листа REF_SHEET, а если её нет, различные имена
+# из колонки J зеркала (каноническое написание — самое частое). Ключ — нормализованное ФИО
+# с отсортированными словами ("Имя Фамилия" == "Фамилия Имя"). Кандидатов даёт триграммный
+# индекс: при расстоянии правки k общих триграмм не меньше |Q| - 3k, поэтому достаточно
+# объединить 3k+1 самых коротких списков. Левенштейн (с полосой k) — только по отобранным,
+# от самых похожих; найденное расстояние сразу ужесточает порог для остальных. Справочник из
+# колонки J содержит и записанные опечатки, поэтому там и точное совпадение сверяется с соседями.
+# По умолчанию похожее имя только подсказываем. EMPLOYEE_AUTOFIX=1 разрешает править само,
+# но лишь опечатки: слова, отличающиеся окончанием (Иванов/Иванова), — это разные люди.
+EMPLOYEE_AUTOFIX = _env_flag("EMPLOYEE_AUTOFIX", "0")
+_emp_seen = {}           # ключ -> {написание: строк} по колонке J зеркала
+_emp_seen_version = 0    # растёт, когда ключ появляется или пропадает
+_emp_index = None        # (источник, {ключ: написание}, {ключ: триграммы}, {триграмма: set(ключ)})
+_emp_lock = threading.Lock()
+
+def _emp_key(name: str) -> str:
+    return " ".join(sorted(_find_norm(name).split()))
+
+def _emp_grams(key: str) -> frozenset:
+    return frozenset(_trigrams(f" {key} "))
+
+def _emp_hook(event: str, rows: list):
+    global _emp_seen_version
+    with _emp_lock:
+        sign = -1 if event == "delete" else 1
+        norm = {}
+        for r in rows:
+            if not r.employee or r.amount is None:
+                continue   # пустые строки и заголовки листов
+            key = norm.get(r.employee)
+            if key is None:
+                key = norm[r.employee] = _emp_key(r.employee)
+            spellings = _emp_seen.get(key)
+            if spellings is None:
+                if sign < 0:
+                    continue
+                spellings = _emp_seen[key] = {}
+                _emp_seen_version += 1
+            n = spellings.get(r.employee, 0) + sign
+            if n > 0:
+                spellings[r.employee] = n
+            else:
+                spellings.pop(r.employee, None)
+            if not spellings:
+                del _emp_seen[key]
+                _emp_seen_version += 1
+
+_ops_hooks.append(_emp_hook)
+
+def _emp_directory():
+    # -> (источник, names, key_grams, grams) или None; пересобирается, только когда сменился источник
+    global _emp_index
+    r = ref()
+    if not r.employees:
+        try:
+            ops_mirror()
+        except Exception as e:
+            print("employee directory error:", repr(e))
+            return None
+    with _emp_lock:
+        source = ("ref", r.version) if r.employees else ("ops", _emp_seen_version)
+        if _emp_index is not None and _emp_index[0] == source:
+            return _emp_index
+        if r.employees:
+            names = {_emp_key(x): x for x in r.employees}
+        else:
+            names = {k: max(v, key=v.get) for k, v in _emp_seen.items()}
+        key_grams = {k: _emp_grams(k) for k in names}
+        grams = {}
+        for k, kg in key_grams.items():
+            for g in kg:
+                posting = grams.get(g)
+                if posting is None:
+                    posting = grams[g] = set()
+                posting.add(k)
+        _emp_index = (source, names, key_grams, grams)
+        return _emp_index
+
+def _levenshtein(a: str, b: str, limit: int) -> int:
+    # расстояние правки в полосе |i - j| <= limit; всё, что больше limit, — limit + 1
+    big = limit + 1
+    if abs(len(a) - len(b)) > limit:
+        return big
+    prev = [j if j <= limit else big for j in range(len(b) + 1)]
+    for i, ca in enumerate(a, start=1):
+        lo, hi = max(1, i - limit), min(len(b), i + limit)
+        cur = [big] * (len(b) + 1)
+        if i <= limit:
+            cur[0] = i
+        for j in range(lo, hi + 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != b[j - 1]))
+        if min(cur[lo - 1:hi + 1]) > limit:
+            return big
+        prev = cur
+    return min(prev[-1], big)
+
+def _emp_nearest(q: str, key_grams: dict, grams: dict, limit: int = 3) -> list:
+    # ключи справочника (кроме самого q) на наименьшем расстоянии правки от q, не дальше порога
+    limit = min(limit, len(q) // 6)
+    if not limit:
+        return []
+    qg = _emp_grams(q)
+    if len(qg) <= 3 * limit:
+        return []
+    postings = sorted((grams.get(g, ()) for g in qg), key=len)[:3 * limit + 1]
+    shared = sorted(
+        ((len(qg & key_grams[k]), k) for k in set().union(*postings) if k != q and abs(len(k) - len(q)) <= limit),
+        reverse=True,
+    )
+    best, best_dist = [], limit + 1
+    for n, k in shared:
+        if n < len(qg) - 3 * min(limit, best_dist):
+            break
+        dist = _levenshtein(q, k, min(limit, best_dist))
+        if dist < best_dist:
+            best, best_dist = [k], dist
+        elif dist == best_dist and best:
+            best.append(k)
+    return best
+
+def _emp_rows(key: str) -> int:
+    with _emp_lock:
+        return sum(_emp_seen.get(key, {}).values())
+
+def match_employee(name: str):
+    # -> написание из справочника или None (не нашёл / два одинаково близких)
+    d = _emp_directory()
+    if d is None:
+        return None
+    source, names, key_grams, grams = d
+    q = _emp_key(name)
+    if q in names:
+        if source[0] != "ops":
+            return names[q]
+        # справочник из колонки J: опечатка, записанная хоть раз, — уже свой ключ. Если в одной
+        # правке есть написание, которое встречается чаще, подсказываем его (дальше — скорее
+        # другой человек: Тогаев/Жобаев)
+        near = _emp_nearest(q, key_grams, grams, 1)
+        if near:
+            top = max(near, key=_emp_rows)
+            if _emp_rows(top) > _emp_rows(q):
+                return names[top]
+        return names[q]
+    near = _emp_nearest(q, key_grams, grams)
+    if len(near) != 1:
+        return None
+    if source[0] == "ops":
+        return match_employee(names[near[0]])   # ближайшее само может оказаться редкой опечаткой
+    return names[near[0]]
+
+def _emp_typo_only(typed_key: str, canon_key: str) -> bool:
+    # можно править само: те же слова, в каждом отличающемся — одна правка не в окончании
+    typed, canon = typed_key.split(), canon_key.split()
+    if len(typed) != len(canon):
+        return False
+    for a, b in zip(typed, canon):
+        if a == b:
+            continue
+        if min(len(a), len(b)) < 5 or _levenshtein(a, b, 1) > 1:
+            return False
+        if max(len(a), len(b)) - len(os.path.commonprefix([a, b])) <= 2:
+            return False   # Иванов/Иванова, Александр/Александра
+    return True
+
+def canon_employee(name: str) -> tuple:
+    # -> (что писать, подсказка из справочника или None)
+    match = match_employee(name)
+    if not match or match == name:
+        return name, None
+    typed_key, canon_key = _emp_key(name), _emp_key(match)
+    if typed_key == canon_key or EMPLOYEE_AUTOFIX and _emp_typo_only(typed_key, canon_key):
+        return match, None   # одно и то же имя (регистр, ё, порядок слов) правим всегда
+    return name, match
+
+def _canon_items(items: list) -> tuple:
+    # /bulk: правит item["name"] на месте -> ([(было, стало)], [(как ввели, подсказка)])
+    fixed, hints = [], []
+    for it in items:
+        name, hint = canon_employee(it["name"])
+        if hint:
+            hints.append((name, hint))
+        elif name != it["name"]:
+            fixed.append((it["name"], name))
+            it["name"] = name
+    return fixed, hints
+
+def _canon_lines(fixed: list, hints: list) -> list:
+    lines = []
+    if fixed:
+        lines.append(f"✏️ Имена по справочнику: {len(fixed)}")
+        lines.extend(f"{a} → {b}" for a, b in fixed[:BULK_FILE_ERRORS_SHOWN])
+    if hints:
+        lines.append(f"❓ Нет в справочнике, оставил как ввели: {len(hints)}")
+        lines.extend(f"{a} — может, {b}?" for a, b in hints[:BULK_FILE_ERRORS_SHOWN])
+    return lines
+
+# =========================
+# EXPORT (/export ПЕРИОД [ОБЪЕКТ])
+# =========================
+# ОПЕРАЦИИ читаются страницами по EXPORT_PAGE_ROWS строк (несколько страниц за один batchGet),
+# подходящие строки сразу уходят в gzip-CSV во временном файле — в памяти не больше пачки страниц.
+EXPORT_PAGE_ROWS = max(100, int(os.environ.get("EXPORT_PAGE_ROWS", "2000")))
+EXPORT_CSV_DELIMITER = os.environ.get("EXPORT_CSV_DELIMITER", ";")   # ; — для русского Excel
+EXPORT_MAX_BYTES = 50 * 1024 * 1024   # предел Bot API на sendDocument
+EXPORT_HEADER = ["DateTime", "Объект", "Тип", "Статья", "СуммаБаза", "СпособОплаты", "НДС", "Категория",
+                 "ПЕРИОД", "Сотрудник", "Статус", "Источник", "MessageID", "Комментарий"]
+_export_lock = threading.Lock()       # одна выгрузка на процесс: она долгая и ест квоту чтения
+_export_cmd_re = re.compile(r"^/export(?:@\w+)?(?:\s+(.+?))?\s*$", re.IGNORECASE)
+_period_value_re = re.compile(r"^\d{4}-\d{2}-[12]$")
+
+def export_operations(fileobj, period_query: str, object_query: str = "*"):
+    # пишет CSV в fileobj (текстовый), возвращает (строк выгружено, строк просмотрено)
+    obj_key = None if object_query.strip() in ("", "*") else _ref_key(object_query)
+    w = csv.writer(fileobj, delimiter=EXPORT_CSV_DELIMITER)
+    w.writerow(EXPORT_HEADER)
+    matched = scanned = 0
+    # суммы как в таблице ("1000,5"): CSV с ";" открывают в русском Excel, ему нужна запятая
+    for _, start, page in iter_ops_pages(period_query, EXPORT_PAGE_ROWS, "FORMATTED_VALUE"):
+        for i, v in enumerate(page):
+            if not v:
+                continue
+            scanned += 1
+            period = str(v[8]).strip() if len(v) > 8 else ""
+            if start + i == 1 and not _period_value_re.match(period):
+                continue   # строка заголовков
+            if not _period_match(period, period_query):
+                continue
+            if obj_key is not None and _ref_key(v[1] if len(v) > 1 else "") != obj_key:
+                continue
+            w.writerow(list(v) + [""] * (len(EXPORT_HEADER) - len(v)))
+            matched += 1
+    return matched, scanned
+
+def _export_job(chat_id, period_query: str, object_query: str, log_ctx: tuple):
+    # фоновый поток: выгрузка, отправка файла, лог; _export_lock уже взят вызывающим
+    user_id, username, full_name, message_id, text = log_ctx
+    _sheets_ctx.prio = PRIO_BACKGROUND
+    path = None
+    try:
+        t0 = time.perf_counter()
+        fd, path = tempfile.mkstemp(prefix="export-", suffix=".csv.gz")
+        os.close(fd)
+        with gzip.open(path, "wt", encoding="utf-8-sig", newline="") as f:
+            matched, scanned = export_operations(f, period_query, object_query)
+        read_s = time.perf_counter() - t0
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_BYTES:
+            send_message(chat_id, f"❌ Выгрузка слишком большая ({size // (1024 * 1024)} МБ). Сузь период или объект.")
+            log_event(chat_id, user_id, username, full_name, message_id, text, "EXPORT ERR", f"too big: {size} bytes")
+            return
+        obj_part = "" if object_query in ("", "*") else " " + ref().objects_map.get(_ref_key(object_query), object_query)
+        caption = (f"ОПЕРАЦИИ {period_query}{obj_part}: {matched} строк из {scanned}, "
+                   f"{read_s:.1f} с, {size // 1024 or 1} КБ (gzip)")
+        filename = f"operations_{period_query.replace('*', 'all')}.csv.gz"
+        if telegram_client().send_document(chat_id, path, filename, caption) is None:
+            raise RuntimeError("Telegram не принял файл (sendDocument)")
+        log_event(chat_id, user_id, username, full_name, message_id, text, "EXPORT OK",
+                  f"{matched}/{scanned} rows, {size} bytes, {(time.perf_counter() - t0) * 1000:.0f} ms")
+    except Exception as e:
+        print("EXPORT error:", repr(e))
+        send_message(chat_id, f"❌ Ошибка /export: {e}")
+        log_event(chat_id, user_id, username, full_name, message_id, text, "EXPORT ERR", str(e))
+    finally:
+        if path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        _export_lock.release()
 
 # =========================
 # ROUTES
@@ -556,6 +3049,14 @@ def _write_operation(parsed: dict, message_id):
 def index():
     return "ok", 200
 
+@app.get("/metrics")
+def metrics_route():
+    if METRICS_TOKEN:
+        got = (request.headers.get("Authorization") or "").strip()
+        if got != f"Bearer {METRICS_TOKEN}":
+            return "forbidden", 403
+    return metrics.render(_metrics_gauges()), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 @app.post("/webhook")
 def webhook():
     # --- Webhook security ---
@@ -565,6 +3066,39 @@ def webhook():
             return "forbidden", 403
 
     data = request.get_json(silent=True) or {}
+
+    if WEBHOOK_ASYNC:
+        if not enqueue_update(data):
+            # Telegram повторит доставку позже
+            return "busy", 503
+        return "queued", 200
+
+    return process_update(data)
+
+_METRIC_COMMANDS = ("/whoami", "/start", "/quick", "/bulk", "/done", "/undo_bulk", "/new", "/cancel",
+                    "/report", "/export", "/find", "/undo", "/back")
+
+def _update_branch(text: str) -> str:
+    # метка для icbot_update_seconds: команда или "text" (уточняется внутри process_update)
+    if not text.startswith("/"):
+        return "text"
+    cmd = text.split()[0].split("@")[0].lower()
+    return cmd if cmd in _METRIC_COMMANDS else "/other"
+
+def process_update(data: dict):
+    msg = data.get("message") or data.get("edited_message") or {}
+    _update_ctx.label = _update_branch((msg.get("text") or "").strip())
+    _sheets_ctx.prio = PRIO_OP
+    t0 = time.perf_counter()
+    try:
+        return _process_update(data)
+    finally:
+        dt = time.perf_counter() - t0
+        metrics.observe("icbot_update_seconds", dt, branch=_update_ctx.label)
+        if "first_update" not in _boot_timings:
+            _boot_timings["first_update"] = dt
+
+def _process_update(data: dict):
     msg = data.get("message") or data.get("edited_message")
     if not msg:
         return "no message", 200
@@ -586,6 +3120,13 @@ def webhook():
     message_id = msg.get("message_id")
     text = (msg.get("text") or "").strip()
 
+    # повторная доставка того же апдейта от Telegram — молча, в том числе для команд
+    update_id = data.get("update_id")
+    if isinstance(update_id, int) and state_store().seen_update(update_id):
+        _update_ctx.label = "dedup"
+        log_event(chat_id, user_id, username, full_name, message_id, text, "DEDUP UPDATE_ID")
+        return "dup update_id", 200
+
     # ---------- /whoami ----------
     if text.strip().lower() == "/whoami":
         send_message(
@@ -604,10 +3145,13 @@ def webhook():
             "/quick — быстрый ввод (формат)\n"
             "/bulk — массовый ввод авансов\n"
             "/done — закончить /bulk и записать\n"
-            "/undo — отмена последней операции\n"
+            "/undo — отмена последней операции (/undo 3 — трёх последних)\n"
             "/undo_bulk — отмена последней массовой пачки\n"
             "/cancel — отмена режима\n"
             "/back — шаг назад (в /new)\n"
+            "/report ОБЪЕКТ|* ПЕРИОД — сводка (период: 2026-01-1, 2026-01 или 2026)\n"
+            "/export ПЕРИОД [ОБЪЕКТ] — выгрузка ОПЕРАЦИИ в CSV (.csv.gz)\n"
+            "/find ТЕКСТ [ПЕРИОД] — поиск по сотруднику и комментарию\n"
             "/whoami — показать id\n\n"
             + quick_help_text()
         )
@@ -647,50 +3191,64 @@ def webhook():
             send_message(chat_id, "⚠️ Список пуст. Пришли строки 'ФИО сумма' и снова /done")
             return "ok", 200
 
-        batch_id = f"BULK-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
-        ok_cnt = 0
-        bad = 0
+        batch_id = new_batch_id("BULK")
+        parsed_list = [_bulk_parsed(hdr, it, batch_id) for it in items]
 
-        for it in items:
-            try:
-                parsed = {
-                    "object": hdr["object"],
-                    "type": "АВАНС",
-                    "article": hdr["article"],
-                    "amount": it["amount"],
-                    "pay_type": hdr["pay_type"],
-                    "vat": hdr["vat"],
-                    "period": hdr["period"],
-                    "employee": it["name"],
-                    "comment": f'{hdr.get("comment","").strip()} [{batch_id}]'.strip(),
-                }
-                _write_operation(parsed, message_id)
-                ok_cnt += 1
-            except Exception as e:
-                bad += 1
-                print("bulk write item error:", it, repr(e))
+        ranges, err = _write_operations(parsed_list, message_id)
+        ok_cnt = min(len(ranges) * SHEETS_APPEND_CHUNK, len(parsed_list))
+
+        if err:
+            print("bulk write error:", batch_id, repr(err))
+            if not ranges:
+                # ничего не записалось — оставляем пачку, можно повторить /done
+                send_message(chat_id, f"❌ Ошибка записи пачки: {err}. Ничего не записано, попробуй /done ещё раз.")
+                log_event(chat_id, user_id, username, full_name, message_id, "/done", "BULK_WRITE ERR", str(err))
+                return "ok", 200
+            _bulk_clear(chat_id)
+            send_message(
+                chat_id,
+                f"⚠️ Записал частично: {ok_cnt} из {len(parsed_list)} (строки {_ranges_text(ranges)}). "
+                f"Ошибка: {err}. Batch: {batch_id}. Удалить записанное: /undo_bulk"
+            )
+            log_event(chat_id, user_id, username, full_name, message_id, "/done", "BULK_WRITE PARTIAL", batch_id)
+            if JOURNAL_DB:
+                journal_record(chat_id, "bulk", batch_id, ranges)
+            return "ok", 200
 
         _bulk_clear(chat_id)
 
-        send_message(chat_id, f"✅ Массово записал: {ok_cnt} строк(а). Ошибок: {bad}. Batch: {batch_id}")
+        send_message(chat_id, f"✅ Массово записал: {ok_cnt} строк(а) (строки {_ranges_text(ranges)}). Batch: {batch_id}")
         log_event(chat_id, user_id, username, full_name, message_id, "/done", "BULK_WRITE OK", batch_id)
+        if JOURNAL_DB:
+            journal_record(chat_id, "bulk", batch_id, ranges)
         return "ok", 200
 
     # ---------- /undo_bulk ----------
     if text.strip().lower() == "/undo_bulk":
+        _sheets_ctx.prio = PRIO_UNDO
         try:
-            batch_id = get_last_bulk_batch_id(chat_id)
+            if JOURNAL_DB:
+                last = journal_last(chat_id, ("bulk",))
+                entry_id, _, batch_id, sheet = last[0] if last else (None, None, None, None)
+            else:
+                entry_id, batch_id, sheet = None, get_last_bulk_batch_id(chat_id), None
             if not batch_id:
                 send_message(chat_id, "⚠️ Не нашёл последнюю массовую пачку в логах.")
                 return "ok", 200
 
-            rows = find_rows_by_batch_id_in_ops(batch_id)
-            if not rows:
+            found = find_ops_rows("bulk", batch_id, sheet)
+            if not found:
+                if entry_id:
+                    journal_mark_undone([entry_id])
                 send_message(chat_id, f"⚠️ Не нашёл строки в ОПЕРАЦИИ для batch {batch_id}")
                 return "ok", 200
 
-            delete_rows(SHEET_OPS, rows)
-            send_message(chat_id, f"✅ Удалил массовую пачку: {len(rows)} строк(а). Batch: {batch_id}")
+            for sheet, rows in found:
+                delete_rows(sheet, rows)
+            if entry_id:
+                journal_mark_undone([entry_id])
+            n_rows = sum(len(rows) for _, rows in found)
+            send_message(chat_id, f"✅ Удалил массовую пачку: {n_rows} строк(а). Batch: {batch_id}")
             log_event(chat_id, user_id, username, full_name, message_id, "/undo_bulk", "BULK_UNDO OK", batch_id)
             return "ok", 200
         except Exception as e:
@@ -715,24 +3273,133 @@ def webhook():
         log_event(chat_id, user_id, username, full_name, message_id, text, "CANCEL OK")
         return "ok", 200
 
-    # ---------- /undo ----------
-    if text.strip().lower() == "/undo":
+    # ---------- /report ----------
+    m_report = _report_cmd_re.match(text)
+    if m_report:
+        args = (m_report.group(1) or "").split()
+        if len(args) < 2 or not _report_period_re.match(args[-1]):
+            send_message(chat_id, "Формат: /report ОБЪЕКТ ПЕРИОД\nПримеры:\n/report ОДИНЦОВО 2026-01-1\n/report * 2026-01")
+            return "ok", 200
         try:
-            target_mid = get_last_written_message_id_from_logs(chat_id)
-            if not target_mid:
+            t0 = time.time()
+            report = build_report(" ".join(args[:-1]), args[-1])
+            send_message(chat_id, report)
+            log_event(chat_id, user_id, username, full_name, message_id, text, "REPORT OK", f"{(time.time() - t0) * 1000:.0f} ms")
+        except Exception as e:
+            print("REPORT error:", repr(e))
+            send_message(chat_id, f"❌ Ошибка /report: {e}")
+            log_event(chat_id, user_id, username, full_name, message_id, text, "REPORT ERR", str(e))
+        return "ok", 200
+
+    # ---------- /find ТЕКСТ [ПЕРИОД] ----------
+    m_find = _find_cmd_re.match(text)
+    if m_find:
+        args = (m_find.group(1) or "").split()
+        period_query = "*"
+        if len(args) > 1 and _report_period_re.match(args[-1]):
+            period_query = args.pop()
+        if not args:
+            send_message(chat_id, "Формат: /find ТЕКСТ [ПЕРИОД]\nПримеры:\n/find Тогаев 2026-01\n/find премия")
+            return "ok", 200
+        try:
+            t0 = time.perf_counter()
+            reply = build_find_reply(" ".join(args), period_query)
+            send_message(chat_id, reply)
+            log_event(chat_id, user_id, username, full_name, message_id, text, "FIND OK",
+                      f"{(time.perf_counter() - t0) * 1000:.1f} ms")
+        except Exception as e:
+            print("FIND error:", repr(e))
+            send_message(chat_id, f"❌ Ошибка /find: {e}")
+            log_event(chat_id, user_id, username, full_name, message_id, text, "FIND ERR", str(e))
+        return "ok", 200
+
+    # ---------- /export ПЕРИОД [ОБЪЕКТ] ----------
+    m_export = _export_cmd_re.match(text)
+    if m_export:
+        args = (m_export.group(1) or "").split()
+        if not args or not _report_period_re.match(args[0]):
+            send_message(chat_id, "Формат: /export ПЕРИОД [ОБЪЕКТ]\nПримеры:\n/export 2026-01\n/export 2026-01-2 ОДИНЦОВО")
+            return "ok", 200
+        if not _export_lock.acquire(blocking=False):
+            send_message(chat_id, "⏳ Уже готовлю другую выгрузку, попробуй через минуту.")
+            return "ok", 200
+        send_message(chat_id, "⏳ Готовлю выгрузку, пришлю файлом.")
+        threading.Thread(
+            target=_export_job,
+            args=(chat_id, args[0], " ".join(args[1:]) or "*", (user_id, username, full_name, message_id, text)),
+            name="export", daemon=True,
+        ).start()
+        return "ok", 200
+
+    # ---------- /undo [N] ----------
+    m_undo = _undo_cmd_re.match(text.strip().lower())
+    if m_undo:
+        _sheets_ctx.prio = PRIO_UNDO
+        try:
+            n_undo = max(1, min(int(m_undo.group(1) or 1), UNDO_MAX))
+            if JOURNAL_DB:
+                entries = journal_last(chat_id, ("op", "quick"), n_undo)
+            else:
+                target_mid = get_last_written_message_id_from_logs(chat_id)
+                entries = [(None, "op", target_mid, None)] if target_mid else []
+            if not entries:
                 send_message(chat_id, "⚠️ Нечего отменять (в логах нет последней операции).")
                 log_event(chat_id, user_id, username, full_name, message_id, text, "UNDO WARN", "no last op")
                 return "ok", 200
 
-            row_num = find_row_by_message_id_in_ops(target_mid)
-            if not row_num:
+            found = []       # (entry_id, kind, key, [rows])
+            missing = []     # (entry_id, kind, key)
+            cancelled = []   # (entry_id, key) — операция ещё лежала в outbox
+            by_sheet = {}    # лист -> строки к удалению
+            for entry_id, kind, key, sheet in entries:
+                if kind == "op" and outbox_cancel(chat_id, key):
+                    cancelled.append((entry_id, key))
+                    continue
+                rows = []
+                for sh, sh_rows in find_ops_rows(kind, key, sheet):
+                    by_sheet.setdefault(sh, []).extend(sh_rows)
+                    rows += sh_rows
+                if rows:
+                    found.append((entry_id, kind, key, rows))
+                else:
+                    missing.append((entry_id, kind, key))
+
+            all_rows = sorted((rn for *_, rows in found for rn in rows), reverse=True)
+            for sh, sh_rows in by_sheet.items():
+                delete_rows(sh, sh_rows)
+            # ненайденные тоже помечаем — строки уже нет, следующий /undo пойдёт дальше
+            journal_mark_undone([eid for eid, *_ in found + missing + cancelled if eid])
+
+            for _, kind, key in missing:
+                what = f"batch not found: {key}" if kind == "quick" else f"mid not found: {key}"
+                log_event(chat_id, user_id, username, full_name, message_id, text, "UNDO WARN", what)
+            for _, kind, key, rows in found:
+                if kind == "quick":
+                    what = f"deleted rows {','.join(map(str, rows))} batch={key}"
+                else:
+                    what = f"deleted row {rows[0]} mid={key}"
+                log_event(chat_id, user_id, username, full_name, message_id, text, "UNDO OK", what)
+            for _, key in cancelled:
+                log_event(chat_id, user_id, username, full_name, message_id, text, "UNDO OK", f"outbox mid={key}")
+
+            if cancelled and not found:
+                miss_txt = f" Не нашёл в ОПЕРАЦИИ: {len(missing)}." if missing else ""
+                send_message(chat_id, f"✅ Отменил операций: {len(cancelled)} (ещё не успели уйти в таблицу).{miss_txt}")
+            elif not found:
                 send_message(chat_id, "⚠️ Не нашёл строку в ОПЕРАЦИИ для отмены (MessageID не найден).")
-                log_event(chat_id, user_id, username, full_name, message_id, text, "UNDO WARN", f"mid not found: {target_mid}")
-                return "ok", 200
-
-            delete_row(SHEET_OPS, row_num)
-            send_message(chat_id, f"✅ Отменил последнюю операцию (удалил строку {row_num}).")
-            log_event(chat_id, user_id, username, full_name, message_id, text, "UNDO OK", f"deleted row {row_num} mid={target_mid}")
+            elif len(entries) == 1 and len(all_rows) == 1 and not cancelled:
+                send_message(chat_id, f"✅ Отменил последнюю операцию (удалил строку {all_rows[0]}).")
+            else:
+                if len(by_sheet) > 1:
+                    # номера строк у каждого листа свои — без имени листа "2, 2, 3" не понять
+                    rows_txt = "; ".join(
+                        f"{sh}: {', '.join(str(rn) for rn in sorted(sh_rows))}" for sh, sh_rows in sorted(by_sheet.items())
+                    )
+                else:
+                    rows_txt = ", ".join(str(rn) for rn in sorted(all_rows))
+                miss_txt = f" Не нашёл в ОПЕРАЦИИ: {len(missing)}." if missing else ""
+                out_txt = f" Ещё {len(cancelled)} убрал до отправки в таблицу." if cancelled else ""
+                send_message(chat_id, f"✅ Отменил операций: {len(all_rows)} (удалил строки {rows_txt}).{out_txt}{miss_txt}")
             return "ok", 200
 
         except Exception as e:
@@ -745,27 +3412,26 @@ def webhook():
     now_ts = time.time()
     _cleanup_caches(now_ts)
 
-    # MessageID dedup (молча)
+    # MessageID dedup (молча; message_id уникален только внутри чата)
     if message_id is not None:
-        if message_id in _seen_message_ids:
+        if not state_store().add("seen_mid", f"{chat_id}:{message_id}", DEDUP_TTL_SECONDS):
+            _update_ctx.label = "dedup"
             log_event(chat_id, user_id, username, full_name, message_id, text, "DEDUP MESSAGE_ID")
             return "dup message_id", 200
-        _seen_message_ids[message_id] = now_ts
 
     # Content dedup (с уведомлением)
     norm_text = normalize_text(text)
     if norm_text:
-        key = (chat_id, norm_text)
-        last_ts = _seen_content.get(key)
-        if last_ts and (now_ts - last_ts) <= CONTENT_DEDUP_WINDOW_SECONDS:
+        if not state_store().add("seen_text", f"{chat_id}:{norm_text}", CONTENT_DEDUP_WINDOW_SECONDS):
             send_message(chat_id, "⚠️ Повтор (текст). Не записал.")
+            _update_ctx.label = "dedup"
             log_event(chat_id, user_id, username, full_name, message_id, text, "DEDUP TEXT")
             return "dup content", 200
-        _seen_content[key] = now_ts
 
     # ---------- /bulk flow processing ----------
     st_bulk = _bulk_get(chat_id)
     if st_bulk:
+        _update_ctx.label = "bulk_flow"
         step = st_bulk["step"]
         hdr = st_bulk["hdr"]
         items = st_bulk["items"]
@@ -777,23 +3443,24 @@ def webhook():
                 send_message(chat_id, "❌ Шапка неверная. Нужно: ОБЪЕКТ; СТАТЬЯ; СПОСОБ; НДС; ПЕРИОД; КОММЕНТ")
                 return "ok", 200
 
-            object_ = parts[0]
-            article = parts[1]
-            pay_type = parts[2]
-            vat = (parts[3] or "").upper()
+            r = ref()
+            object_ = r.objects_map.get(_ref_key(parts[0]))
+            article = r.articles_map.get(_ref_key(parts[1]))
+            pay_type = r.pay_types_map.get(_ref_key(parts[2]))
+            vat = r.vat_map.get(_ref_key(parts[3]))
             period = parts[4]
             comment = parts[5] if len(parts) >= 6 else "авансы"
 
-            if object_ not in OBJECTS:
+            if not object_:
                 send_message(chat_id, "❌ Объект не из списка.")
                 return "ok", 200
-            if article not in ARTICLES:
+            if not article:
                 send_message(chat_id, "❌ Статья не из списка.")
                 return "ok", 200
-            if pay_type not in PAY_TYPES:
+            if not pay_type:
                 send_message(chat_id, "❌ Способ оплаты не из списка.")
                 return "ok", 200
-            if vat not in VAT_VALUES:
+            if not vat:
                 send_message(chat_id, "❌ НДС только ДА или НЕТ.")
                 return "ok", 200
             if not re.match(r"^\d{4}-\d{2}-[12]$", period.strip()):
@@ -812,21 +3479,80 @@ def webhook():
             send_message(chat_id, "Шаг 2/2: кидай строки 'ФИО сумма'. Когда закончишь — /done", kb([["/done"], ["/cancel"]]))
             return "ok", 200
 
-        # step 2: items lines
+        # step 2: файл CSV/XLSX — сразу пишем всю пачку
+        if step == 2 and msg.get("document"):
+            send_message(chat_id, "⏳ Читаю файл…")
+            try:
+                batch_id, written, ranges, errors_total, errors_shown, err, fixed, hints = _bulk_write_file(
+                    hdr, items, msg["document"], message_id
+                )
+            except Exception as e:
+                print("bulk file error:", repr(e))
+                send_message(chat_id, f"❌ Файл не принят: {e}")
+                log_event(chat_id, user_id, username, full_name, message_id, "/bulk file", "BULK_FILE ERR", str(e))
+                return "ok", 200
+
+            lines = []
+            if ranges:
+                lines.append(f"✅ Из файла записал: {written} строк(а) (строки {_ranges_text(ranges)}). Batch: {batch_id}")
+                if err:
+                    lines.append(f"❌ Запись прервалась: {err}. Удалить записанное: /undo_bulk")
+            elif err:
+                lines.append(f"❌ Ошибка записи: {err}. Ничего не записано.")
+            else:
+                lines.append("⚠️ В файле не нашёл ни одной строки 'ФИО сумма'.")
+            lines.extend(_canon_lines(fixed, hints))
+            if errors_total:
+                lines.append(f"Пропущено строк с ошибками: {errors_total}")
+                lines.extend(errors_shown)
+            send_message(chat_id, "\n".join(lines))
+
+            if ranges:
+                _bulk_clear(chat_id)
+                status = "BULK_WRITE PARTIAL" if err else "BULK_WRITE OK"
+                log_event(chat_id, user_id, username, full_name, message_id, "/bulk file", status, batch_id)
+                if JOURNAL_DB:
+                    journal_record(chat_id, "bulk", batch_id, ranges)
+            return "ok", 200
+
+        # step 2: items lines (одна строка или сразу вставка из многих)
         if step == 2:
-            val, name = _parse_amount_and_name(text)
-            if not name or val is None:
-                send_message(chat_id, "❌ Строка должна быть как: ФИО 3000 (или ФИО - 5к)")
+            new_items, rejected = _parse_bulk_lines(text)
+            if not new_items:
+                if len(rejected) > 1:
+                    send_message(chat_id, "❌ Не понял ни одной строки. Нужно: ФИО 3000 (или ФИО - 5к), каждая с новой строки")
+                else:
+                    send_message(chat_id, "❌ Строка должна быть как: ФИО 3000 (или ФИО - 5к)")
                 return "ok", 200
 
-            items.append({"name": name, "amount": float(val)})
+            fixed, hints = _canon_items(new_items)
+            items.extend(new_items)
             _bulk_set(chat_id, 2, hdr, items)
-            send_message(chat_id, f"➕ Добавил: {name} — {int(val) if float(val).is_integer() else val}")
+
+            if len(new_items) == 1 and not rejected:
+                name, val = new_items[0]["name"], new_items[0]["amount"]
+                was = f" (ввели: {fixed[0][0]})" if fixed else f" (в справочнике есть {hints[0][1]})" if hints else ""
+                send_message(chat_id, f"➕ Добавил: {name} — {int(val) if float(val).is_integer() else val}{was}")
+                return "ok", 200
+
+            added_sum = sum(it["amount"] for it in new_items)
+            total_sum = sum(it["amount"] for it in items)
+            lines = [
+                f"➕ Добавил строк: {len(new_items)} на {_fmt_amount(added_sum)}",
+                f"В пачке: {len(items)} на {_fmt_amount(total_sum)}. Когда закончишь — /done",
+            ]
+            lines.extend(_canon_lines(fixed, hints))
+            if rejected:
+                lines.append(f"❌ Не понял строк: {len(rejected)}")
+                lines.extend(f"{n}: {line[:60]}" for n, line in rejected[:BULK_FILE_ERRORS_SHOWN])
+            send_message(chat_id, "\n".join(lines))
             return "ok", 200
 
     # ---------- /new flow processing ----------
     st = _newflow_get(chat_id)
     if st:
+        if _update_ctx.label == "text":
+            _update_ctx.label = "new_flow"
         step = st["step"]
         data_nf = st["data"]
 
@@ -837,31 +3563,34 @@ def webhook():
             return "ok", 200
 
         if step == 1:
-            if text not in OBJECTS:
+            value = ref().objects_map.get(_ref_key(text))
+            if not value:
                 send_message(chat_id, "❌ Выбери объект кнопкой.")
                 _ask_step(chat_id, 1)
                 return "ok", 200
-            data_nf["object"] = text
+            data_nf["object"] = value
             _newflow_set(chat_id, 2, data_nf)
             _ask_step(chat_id, 2)
             return "ok", 200
 
         if step == 2:
-            if text not in TYPES:
+            value = ref().types_map.get(_ref_key(text))
+            if not value:
                 send_message(chat_id, "❌ Выбери тип кнопкой.")
                 _ask_step(chat_id, 2)
                 return "ok", 200
-            data_nf["type"] = text
+            data_nf["type"] = value
             _newflow_set(chat_id, 3, data_nf)
             _ask_step(chat_id, 3)
             return "ok", 200
 
         if step == 3:
-            if text not in ARTICLES:
+            value = ref().articles_map.get(_ref_key(text))
+            if not value:
                 send_message(chat_id, "❌ Выбери статью кнопкой.")
                 _ask_step(chat_id, 3)
                 return "ok", 200
-            data_nf["article"] = text
+            data_nf["article"] = value
             _newflow_set(chat_id, 4, data_nf)
             _ask_step(chat_id, 4)
             return "ok", 200
@@ -882,21 +3611,23 @@ def webhook():
             return "ok", 200
 
         if step == 5:
-            if text not in PAY_TYPES:
+            value = ref().pay_types_map.get(_ref_key(text))
+            if not value:
                 send_message(chat_id, "❌ Выбери способ оплаты кнопкой.")
                 _ask_step(chat_id, 5)
                 return "ok", 200
-            data_nf["pay_type"] = text
+            data_nf["pay_type"] = value
             _newflow_set(chat_id, 6, data_nf)
             _ask_step(chat_id, 6)
             return "ok", 200
 
         if step == 6:
-            if text not in VAT_VALUES:
+            value = ref().vat_map.get(_ref_key(text))
+            if not value:
                 send_message(chat_id, "❌ НДС только ДА или НЕТ.")
                 _ask_step(chat_id, 6)
                 return "ok", 200
-            data_nf["vat"] = text
+            data_nf["vat"] = value
             _newflow_set(chat_id, 7, data_nf)
             _ask_step(chat_id, 7)
             return "ok", 200
@@ -916,7 +3647,11 @@ def webhook():
                 send_message(chat_id, "❌ Сотрудник не должен быть пустым.")
                 _ask_step(chat_id, 8)
                 return "ok", 200
-            data_nf["employee"] = text.strip()
+            data_nf["employee"], hint = canon_employee(text.strip())
+            if hint:
+                send_message(chat_id, f"❓ Нет в справочнике, оставил как ввели. Может, {hint}? Исправить: /cancel и заново")
+            elif data_nf["employee"] != text.strip():
+                send_message(chat_id, f"✏️ Сотрудник по справочнику: {text.strip()} → {data_nf['employee']}")
             _newflow_set(chat_id, 9, data_nf)
             _ask_step(chat_id, 9)
             return "ok", 200
@@ -936,9 +3671,11 @@ def webhook():
                     "employee": data_nf["employee"],
                     "comment": data_nf["comment"],
                 }
-                _write_operation(parsed, message_id)
+                rng = _write_operation(parsed, message_id, chat_id)
                 send_message(chat_id, "✅ Записал")
                 log_event(chat_id, user_id, username, full_name, message_id, f"/new {parsed}", "OP_WRITE OK")
+                if JOURNAL_DB:
+                    journal_record(chat_id, "op", message_id, [rng], sheet=ops_sheet_for(parsed["period"]))
             except Exception as e:
                 print("append error:", repr(e))
                 send_message(chat_id, f"❌ Ошибка записи: {e}")
@@ -947,7 +3684,55 @@ def webhook():
             _newflow_clear(chat_id)
             return "ok", 200
 
-    # ---------- fast input (;) ----------
+    # ---------- fast input (;), несколько записей — по одной на строку ----------
+    _update_ctx.label = "quick_input"
+    records = [ln.strip() for ln in text.splitlines() if ln.strip()]
+    if len(records) > 1:
+        if len(records) > QUICK_MAX_RECORDS:
+            send_message(chat_id, f"❌ Не больше {QUICK_MAX_RECORDS} записей в одном сообщении.")
+            log_event(chat_id, user_id, username, full_name, message_id, text, "VALIDATE BAD", "too many records")
+            return "bad format", 200
+
+        parsed_list = []
+        errors = []
+        for n, rec in enumerate(records, start=1):
+            parsed, err = validate_and_parse(rec)
+            if err:
+                errors.append(f"{n}: {err.splitlines()[0].lstrip('❌ ')}")
+            else:
+                parsed_list.append(parsed)
+        if errors:
+            # пишем только если валидны все строки
+            send_message(chat_id, f"❌ Ничего не записал, ошибки в строках ({len(errors)} из {len(records)}):\n" + "\n".join(errors))
+            log_event(chat_id, user_id, username, full_name, message_id, text, "VALIDATE BAD", "; ".join(errors)[:500])
+            return "bad format", 200
+
+        # с разделами каждый месяц — свой лист и свой append; одно сообщение — один append
+        sheets = {ops_sheet_for(p["period"]) for p in parsed_list}
+        if len(sheets) > 1:
+            send_message(chat_id, "❌ Ничего не записал: в одном сообщении строки за разные месяцы. Отправь каждый месяц отдельно.")
+            log_event(chat_id, user_id, username, full_name, message_id, text, "VALIDATE BAD", "mixed months: " + ", ".join(sorted(sheets)))
+            return "bad format", 200
+
+        batch_id = new_batch_id("QUICK")
+        for p in parsed_list:
+            p["comment"] = f'{p["comment"]} [{batch_id}]'.strip()
+        ranges, err = _write_operations(parsed_list, message_id)
+        if err and not ranges:
+            print("append error:", repr(err))
+            send_message(chat_id, f"❌ Ошибка записи: {err}")
+            log_event(chat_id, user_id, username, full_name, message_id, text, "OP_WRITE ERR", str(err))
+            return "ok", 200
+        if err:
+            send_message(chat_id, f"⚠️ Записал частично (строки {_ranges_text(ranges)}): {err}. Отменить: /undo")
+        else:
+            send_message(chat_id, f"✅ Записал {len(parsed_list)} операций (строки {_ranges_text(ranges)})")
+        status = "QUICK_WRITE PARTIAL" if err else "QUICK_WRITE OK"
+        log_event(chat_id, user_id, username, full_name, message_id, text, status, batch_id)
+        if JOURNAL_DB:
+            journal_record(chat_id, "quick", batch_id, ranges)
+        return "ok", 200
+
     parsed, err = validate_and_parse(text)
     if err:
         send_message(chat_id, err)
@@ -955,9 +3740,11 @@ def webhook():
         return "bad format", 200
 
     try:
-        _write_operation(parsed, message_id)
+        rng = _write_operation(parsed, message_id, chat_id)
         send_message(chat_id, "✅ Записал")
         log_event(chat_id, user_id, username, full_name, message_id, text, "OP_WRITE OK")
+        if JOURNAL_DB:
+            journal_record(chat_id, "op", message_id, [rng], sheet=ops_sheet_for(parsed["period"]))
     except Exception as e:
         print("append error:", repr(e))
         send_message(chat_id, f"❌ Ошибка записи: {e}")
@@ -965,6 +3752,111 @@ def webhook():
 
     return "ok", 200
 
+# =========================
+# LONG POLLING (python main.py --poll)
+# =========================
+# Без webhook: getUpdates пачками до 100 апдейтов. Пачка раскладывается по тем же
+# шардированным воркерам, что и ack-first режим (разные чаты параллельно, один чат по порядку),
+# поэтому записи в ОПЕРАЦИИ склеиваются group commit'ом, а логи уходят одним append в конце пачки.
+# offset сохраняется в POLL_OFFSET_FILE только после обработки пачки.
+POLL_TIMEOUT = int(os.environ.get("POLL_TIMEOUT", "50"))
+POLL_LIMIT = 100
+POLL_OFFSET_FILE = os.environ.get("POLL_OFFSET_FILE", "poll_offset.txt").strip()
+
+def _load_poll_offset() -> int:
+    try:
+        with open(POLL_OFFSET_FILE, "r", encoding="utf-8") as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+    except ValueError:
+        print("poll offset file is broken, starting from 0")
+        return 0
+
+def _save_poll_offset(offset: int):
+    tmp = POLL_OFFSET_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(str(offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, POLL_OFFSET_FILE)
+
+def _dispatch_batch(updates: list):
+    _start_update_workers()
+    for u in updates:
+        _update_queue_for(u).put(u)
+    for q in _update_queues:
+        q.join()
+    flush_logs()
+
+def run_polling():
+    offset = _load_poll_offset()
+    print("polling started, offset", offset)
+    while True:
+        body = json.dumps({
+            "offset": offset,
+            "timeout": POLL_TIMEOUT,
+            "limit": POLL_LIMIT,
+            "allowed_updates": ["message", "edited_message"],
+        })
+        updates = telegram_client().call("getUpdates", body, timeout=POLL_TIMEOUT + 10)
+        if updates is None:
+            time.sleep(3)
+            continue
+        if not updates:
+            continue
+        t0 = time.time()
+        _dispatch_batch(updates)
+        offset = max(u.get("update_id", 0) for u in updates) + 1
+        _save_poll_offset(offset)
+        print(f"poll batch: {len(updates)} updates in {time.time() - t0:.2f}s")
+
+# =========================
+# SHUTDOWN
+# =========================
+def _shutdown():
+    # порядок важен: сначала дорабатываем очередь апдейтов, потом outbox и накопленные логи
+    _drain_update_queues()
+    if OUTBOX_DB:
+        try:
+            outbox_flush()
+        except Exception as e:
+            print("outbox flush on shutdown error:", repr(e))
+    flush_logs()
+
+atexit.register(_shutdown)
+
+# =========================
+# COLD START
+# =========================
+def warm_up():
+    # вызывается один раз в каждом процессе-обработчике: после fork (gunicorn.conf.py) или из __main__
+    t0 = time.perf_counter()
+    try:
+        svc = build_sheets_service()
+        t1 = time.perf_counter()
+        _load_sheet_ids(svc)
+        t2 = time.perf_counter()
+        _boot_timings["sheet_ids"] = t2 - t1
+        ref()
+        _boot_timings["ref"] = time.perf_counter() - t2
+        telegram_client()
+        outbox_resume()
+    except Exception as e:
+        print("warm up error:", repr(e))
+    _boot_timings["warm_up"] = time.perf_counter() - t0
+    print("cold start:", ", ".join(f"{k}={v:.3f}s" for k, v in _boot_timings.items()))
+
+_boot_timings["import"] = time.perf_counter() - _boot_t0
+
 if __name__ == "__main__":
-    port = int(os.environ.get("PORT", "8080"))
-    app.run(host="0.0.0.0", port=port)
+    if PREWARM:
+        warm_up()
+    if "--poll" in sys.argv[1:]:
+        try:
+            run_polling()
+        except KeyboardInterrupt:
+            pass
+    else:
+        port = int(os.environ.get("PORT", "8080"))
+        app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,71 @@
+# Зеркало ОПЕРАЦИИ: перечит листа не должен держать запись. Фейковые Sheets из bench.py, без сети.
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench  # noqa: E402  (выставляет окружение и импортирует main)
+
+main = bench.main
+
+
+def _row(mid):
+    parsed = {"object": "ОБУХОВО", "type": "РАСХОД", "article": "КВАРТИРА", "amount": 100.0,
+              "pay_type": "НАЛ", "vat": "НЕТ", "period": "2026-01-1", "employee": "ИВАНОВ", "comment": "-"}
+    return main._op_row(parsed, mid, "2026-01-01 10:00:00")
+
+
+@pytest.fixture
+def sheets(monkeypatch):
+    fake = bench.FakeSheets()
+    fake._sheet(main.SHEET_OPS).extend(_row(i) for i in range(1, 41))
+    monkeypatch.setattr(main, "_sheets_service", fake)
+    monkeypatch.setattr(main, "SPREADSHEET_ID", "test")
+    main._ops_parts.clear()
+    main._sheet_id_cache.clear()
+    yield fake
+    main._ops_parts.clear()
+
+
+def _hold_reads(fake, monkeypatch, after_read: bool):
+    # batchGet ждёт gate: до чтения данных (after_read=False) или уже прочитав их (True)
+    gate, entered = threading.Event(), threading.Event()
+    orig = fake.batchGet
+
+    class Held:
+        def __init__(self, req):
+            self.req = req
+
+        def execute(self, **kwargs):
+            entered.set()
+            if not after_read:
+                gate.wait(5)
+            resp = self.req.execute(**kwargs)
+            if after_read:
+                gate.wait(5)
+            return resp
+
+    monkeypatch.setattr(fake, "batchGet", lambda **kw: Held(orig(**kw)))
+    return gate, entered
+
+
+@pytest.mark.parametrize("after_read", [False, True])
+def test_append_does_not_wait_for_mirror_load(sheets, monkeypatch, after_read):
+    gate, entered = _hold_reads(sheets, monkeypatch, after_read)
+    loader = threading.Thread(target=main.ops_mirror)
+    loader.start()
+    assert entered.wait(5)
+
+    writer = threading.Thread(target=main.append_rows, args=(main.SHEET_OPS, [_row(41)]))
+    writer.start()
+    writer.join(2)
+    assert not writer.is_alive()   # запись не ждала перечитывания листа
+
+    gate.set()
+    loader.join(5)
+    part = main._ops_parts[main.SHEET_OPS]
+    assert part.loaded
+    assert [r.mid for r in part.rows] == [str(i) for i in range(1, 42)]
+    assert part.by_mid["41"] == [41]
@@ -0,0 +1,70 @@
+# Регрессии outbox: фейковые Sheets из bench.py, без сети.
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench  # noqa: E402  (выставляет окружение и импортирует main)
+
+main = bench.main
+
+
+def _row(mid, comment="-"):
+    parsed = {"object": "ОБУХОВО", "type": "РАСХОД", "article": "КВАРТИРА", "amount": 100.0,
+              "pay_type": "НАЛ", "vat": "НЕТ", "period": "2026-01-1", "employee": "ИВАНОВ", "comment": comment}
+    return main._op_row(parsed, mid, "2026-01-01 10:00:00")
+
+
+@pytest.fixture
+def sheets(tmp_path, monkeypatch):
+    fake = bench.FakeSheets()
+    fake._sheet(main.SHEET_OPS)
+    monkeypatch.setattr(main, "_sheets_service", fake)
+    monkeypatch.setattr(main, "SPREADSHEET_ID", "test")
+    monkeypatch.setattr(main, "OUTBOX_DB", str(tmp_path / "outbox.sqlite3"))
+    monkeypatch.setattr(main, "_outbox_db", None)
+    monkeypatch.setattr(main, "_start_outbox_flusher", lambda: None)   # переносим руками
+    main._ops_parts.clear()
+    main._sheet_id_cache.clear()
+    return fake
+
+
+def test_flush_retry_keeps_row_with_same_message_id_from_other_chat(sheets):
+    # чат 111, сообщение 42 — уже в ОПЕРАЦИИ
+    main.outbox_put([_row(42)], 1001)
+    assert main.outbox_flush() == 1
+
+    # чат 222, тоже сообщение 42: первый перенос падает на 503
+    main.outbox_put([_row(42)], 1002)
+    sheets.error_rate = 1.0
+    with pytest.raises(Exception):
+        main.outbox_flush()
+    sheets.error_rate = 0.0
+
+    assert main.outbox_flush() == 1
+    assert main.outbox_pending() == 0
+    assert [r[12] for r in sheets.data[main.SHEET_OPS]] == ["42", "42"]
+
+
+def test_flush_retry_skips_row_that_already_reached_sheet(sheets):
+    main.outbox_put([_row(7)], 1001)
+    # append дошёл, но ответ потерялся: строка в таблице, в outbox attempts > 0
+    with main._outbox_lock:
+        oid, raw = main._outbox().execute("SELECT id, row FROM outbox").fetchone()
+        main._outbox().execute("UPDATE outbox SET attempts = 1 WHERE id = ?", (oid,))
+    sheets.data[main.SHEET_OPS].append(main.json.loads(raw))
+
+    assert main.outbox_flush() == 0
+    assert main.outbox_pending() == 0
+    assert len(sheets.data[main.SHEET_OPS]) == 1
+
+
+def test_cancel_removes_only_row_of_own_chat(sheets):
+    main.outbox_put([_row(5)], 1001)
+    main.outbox_put([_row(5)], 1002)
+
+    assert main.outbox_cancel(1002, 5) == 1
+    assert main.outbox_cancel(1002, 5) == 0
+    assert main.outbox_pending() == 1
+    assert main.outbox_flush() == 1